@@ -0,0 +1,256 @@
+#!/bin/python3
+# benchmark.py - end to end latency benchmark for the slideclicker server
+#
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" End to end latency benchmark for the slideclicker server
+
+This runs the real bluetooth Watcher, but over a socketpair instead of an
+RFCOMM connection, takes screenshots of generated slides instead of asking
+gnome-shell, and records key presses instead of sending them to uinput.
+That means it runs on any Linux box with GLib, dbus-python and Pillow:
+no BlueZ, gnome-shell or root needed.
+
+It reports p50/p99 latency for clicks, pings and screenshots, and the number
+of bytes that went over the "wire". """
+
+import argparse
+import json
+import logging
+import socket
+import threading
+import time
+from PIL import Image, ImageDraw
+from gi.repository import GLib
+import slideclicker.bluetooth
+import slideclicker.screenshot
+from slideclicker.bluetooth import Watcher
+from slideclicker.screenshot import RawBackend, set_backend
+
+SLIDE_SIZE = (1920, 1080)
+
+
+def make_slides(count):
+    """ Generate a deck of raw RGB slides: mostly text slides where the
+        bullet points build up, with a photo-like slide every now and then """
+    slides = []
+    for i in range(count):
+        if i % 4 == 3:
+            noise = Image.effect_noise(SLIDE_SIZE, 64)
+            gradient = Image.linear_gradient("L").resize(SLIDE_SIZE)
+            img = Image.merge("RGB", (noise, gradient,
+                                      noise.transpose(Image.FLIP_LEFT_RIGHT)))
+        else:
+            img = Image.new("RGB", SLIDE_SIZE, "white")
+            draw = ImageDraw.Draw(img)
+            draw.rectangle((0, 0, SLIDE_SIZE[0], 160), fill=(30, 60, 120))
+            draw.text((80, 60), "Slide %d" % i, fill="white")
+            for line in range(i % 4 + 1):
+                top = 260 + line * 140
+                draw.ellipse((100, top + 20, 140, top + 60), fill="black")
+                draw.rectangle((180, top, 180 + 300 * (line + 2), top + 80),
+                               fill=(80, 80, 80))
+        slides.append(img.tobytes())
+    return slides
+
+
+class Deck(object):
+    """ A slide deck, shown through a RawBackend """
+    def __init__(self, slides):
+        self.slides = slides
+        self.index = 0
+        self.backend = RawBackend(slides[0], SLIDE_SIZE)
+
+    def move(self, offset):
+        self.index = max(0, min(len(self.slides) - 1, self.index + offset))
+        self.backend.set_frame(self.slides[self.index])
+
+
+class RecordingKeyboard(object):
+    """ Stands in for kbd_client.KeyboardClient: instead of sending keys to
+        uinput, change the slide and record when the keys arrived """
+    def __init__(self, deck):
+        self.deck = deck
+        self.pressed = threading.Event()
+        self.pressed_at = None
+
+    def connect(self):
+        pass
+
+    def send_batch(self, commands):
+        for what, count in commands:
+            self.deck.move(count if what == b"dn" else -count)
+        self.pressed_at = time.perf_counter()
+        self.pressed.set()
+
+
+class BenchmarkWatcher(Watcher):
+    """ A Watcher that counts the refinements it asks for. In progressive
+        mode there's only one if it's going to be better than the preview """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.refinements = 0
+
+    def request_screenshot(self, hq=False, settle=True, fingerprint=None):
+        if hq:
+            self.refinements += 1
+        super().request_screenshot(hq, settle, fingerprint)
+
+
+class BenchmarkClient(object):
+    """ Plays the phone's part of the protocol over a socket """
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def send(self, data):
+        self.sock.sendall(data)
+        self.bytes_sent += len(data)
+
+    def recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise Exception("server closed the connection")
+            data += chunk
+        self.bytes_received += size
+        return bytes(data)
+
+    def read_message(self):
+        """ Read one message from the server, return its kind """
+        kind = self.recv_exactly(4)
+        if kind in (b"pic:", b"dlt:"):
+            self.recv_exactly(int(self.recv_exactly(8)))
+        elif kind == b"wifi":
+            self.recv_exactly(int(self.recv_exactly(4)))
+        elif kind != b"pong":
+            raise Exception("junk from the server: %r" % kind)
+        return kind
+
+    def wait_for(self, *kinds):
+        while self.read_message() not in kinds:
+            pass
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(percent / 100 * (len(values) - 1)))]
+
+
+def run_client(client, keyboard, watcher, args, results):
+    """ Click through the deck, timing everything """
+    client.send(json.dumps({"wifi": False, "progressive": args.progressive,
+                            "delta": args.delta}).encode())
+    for i in range(args.iterations):
+        # Go forward through the deck, and then back again
+        command = b"dn" if (i // (args.slides - 1)) % 2 == 0 else b"up"
+        keyboard.pressed.clear()
+        start = time.perf_counter()
+        client.send(command)
+        if not keyboard.pressed.wait(5):
+            raise Exception("key press never arrived")
+        results["click"].append(keyboard.pressed_at - start)
+
+        refinements = watcher.refinements
+        start = time.perf_counter()
+        client.send(b"sc")
+        client.wait_for(b"pic:", b"dlt:")
+        results["screenshot"].append(time.perf_counter() - start)
+        # the server asks for the refinement before it sends the preview
+        if watcher.refinements > refinements:
+            client.wait_for(b"pic:", b"dlt:")
+            results["screenshot (refined)"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        client.send(b"pi")
+        client.wait_for(b"pong")
+        results["ping"].append(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="slideclicker latency benchmark")
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--slides', type=int, default=12)
+    parser.add_argument('--progressive', action='store_true',
+                        help='ask for progressive screenshots')
+    parser.add_argument('--delta', action='store_true',
+                        help='ask for delta encoded screenshots')
+    parser.add_argument('--box-downscale', action='store_true',
+                        help='pre-shrink frames with Image.reduce() before resizing')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help="keep the server's screenshot rate limit (the "
+                             "benchmark clicks faster than any human)")
+    args = parser.parse_args()
+    if args.slides < 2:
+        parser.error("need at least two slides to click through")
+    logging.basicConfig(level=logging.WARNING)
+    slideclicker.screenshot.BOX_DOWNSCALE = args.box_downscale
+    if not args.rate_limit:
+        slideclicker.screenshot.SCREENSHOT_RATE = 1000000
+        slideclicker.screenshot.SCREENSHOT_BURST = 1000000
+
+    deck = Deck(make_slides(args.slides))
+    set_backend(deck.backend)
+    keyboard = RecordingKeyboard(deck)
+    slideclicker.bluetooth.kbd = keyboard
+
+    server_sock, client_sock = socket.socketpair()
+    client_sock.settimeout(10)
+    watcher = BenchmarkWatcher(server_sock.detach(), "/benchmark")
+    watcher.start()
+    client = BenchmarkClient(client_sock)
+
+    results = {"click": [], "screenshot": [], "ping": []}
+    if args.progressive:
+        results["screenshot (refined)"] = []
+    mainloop = GLib.MainLoop()
+    errors = []
+
+    def client_thread():
+        try:
+            run_client(client, keyboard, watcher, args, results)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            GLib.idle_add(mainloop.quit)
+
+    thread = threading.Thread(target=client_thread)
+    thread.start()
+    mainloop.run()
+    thread.join()
+    watcher.stop()
+    client_sock.close()
+    if errors:
+        raise errors[0]
+
+    print("%-22s %6s %10s %10s" % ("path", "count", "p50 (ms)", "p99 (ms)"))
+    for name, values in results.items():
+        if not values:
+            continue  # e.g. no refinements, the preview was good enough
+        print("%-22s %6d %10.2f %10.2f" % (name, len(values),
+                                           percentile(values, 50) * 1000,
+                                           percentile(values, 99) * 1000))
+    print()
+    print("bytes sent by the client:     %d" % client.bytes_sent)
+    print("bytes sent by the server:     %d" % client.bytes_received)
+    print("server bytes per iteration:   %d" % (client.bytes_received /
+                                               args.iterations))
+
+
+if __name__ == "__main__":
+    main()
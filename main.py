@@ -17,40 +17,131 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import dbus
 import argparse
-import slideclicker.logging_config
-import slideclicker.bluetooth
-from gi.repository import GLib
-from slideclicker.bluetooth import Watcher
-from slideclicker.bluetooth_server import register_profile
+import time
+
+# Everything else is imported in main(), so --startup-profile can time it
 
 
 BT_UUID = '00001101-0000-1000-8000-00805F9B34FB'
 DBUS_PATH = '/com/eladalfassa/slideclicker/BluetoothProfile'
 
 
+class StartupTimer(object):
+    """ Print how long each startup step took, if enabled """
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.start = self.last = time.perf_counter()
+
+    def step(self, name):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        print("startup: %-32s %7.1f ms (total %7.1f ms)" %
+              (name, (now - self.last) * 1000, (now - self.start) * 1000))
+        self.last = now
+
+
 def main():
     parser = argparse.ArgumentParser(description="a simple slideshow clicker")
     parser.add_argument('--enable-wifi', action='store_true',
                         help='Enable sending the screenshots for the presenter'
                              ' view over wifi instead of bluetooth. DO NOT '
                              'enable this on public/untrusted networks')
+    parser.add_argument('--progressive', action='store_true',
+                        help='Over bluetooth, follow every low resolution '
+                             'screenshot with a better one')
+    parser.add_argument('--settle-timeout', type=float, default=1.0,
+                        help='Maximum seconds to wait for a slide to finish '
+                             'changing before taking a screenshot of it '
+                             '(default: 1.0)')
+    parser.add_argument('--idle-timeout', type=float, default=12,
+                        help='Close a bluetooth connection after this many '
+                             'seconds without activity. The app pings every '
+                             '10 seconds (default: 12)')
+    parser.add_argument('--capture', metavar='TARGET',
+                        help='What to take screenshots of: "window" (the '
+                             'focused window, default), "screen", "monitor:N" '
+                             'or "area:X,Y,WIDTH,HEIGHT" (just the slide)')
+    parser.add_argument('--save-capture', action='store_true',
+                        help='Remember --capture as the default for next time')
+    parser.add_argument('--metrics-socket', nargs='?', const='', metavar='PATH',
+                        help='Serve metrics (Prometheus text format) on a Unix '
+                             'socket, by default '
+                             '$XDG_RUNTIME_DIR/slideclicker-metrics.sock. '
+                             'Metrics are also logged on SIGUSR1')
+    parser.add_argument('--log-level', metavar='LEVELS',
+                        help='Log levels per subsystem, e.g. '
+                             '"bluetooth=debug,screenshot=warning". A level '
+                             'on its own applies to everything (default: info)')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='Print how long each step of starting up took')
     args = parser.parse_args()
+    timer = StartupTimer(args.startup_profile)
+
+    import dbus.mainloop.glib
+    import signal
+    from gi.repository import GLib
+    timer.step("import dbus and GLib")
+    import slideclicker.logging_config
+    if args.log_level:
+        try:
+            slideclicker.logging_config.set_levels(args.log_level)
+        except ValueError as e:
+            parser.error(str(e))
+    timer.step("set up logging")
+    import slideclicker.bluetooth
+    import slideclicker.screenshot
+    import slideclicker.metrics
+    import slideclicker.bluetooth_server
+    from slideclicker.bluetooth import Watcher
+    from slideclicker.bluetooth_server import register_profile
+    timer.step("import slideclicker")
+
+    slideclicker.screenshot.SETTLE_TIMEOUT = args.settle_timeout
+    slideclicker.bluetooth_server.IDLE_TIMEOUT = args.idle_timeout
+    capture = args.capture or slideclicker.screenshot.load_capture_target()
+    if capture is not None:
+        try:
+            target, argument = slideclicker.screenshot.parse_capture_target(capture)
+            backend = slideclicker.screenshot.ShellBackend(target=target,
+                                                           argument=argument)
+        except ValueError as e:
+            parser.error(str(e))
+        slideclicker.screenshot.set_backend(backend)
+        if args.capture and args.save_capture:
+            slideclicker.screenshot.save_capture_target(args.capture)
+    slideclicker.bluetooth.PROGRESSIVE_ENABLED = args.progressive
     if args.enable_wifi:
         print("wifi functionality enabled")
         print("WARNING! Do not use this feature on public or otherwise untrusted networks")
         slideclicker.bluetooth.WIFI_UPGRADE_ENABLED = True
 
     slideclicker.logging_config.get("main").info("Starting...")
+    slideclicker.bluetooth.kbd.connect()  # fail early if the server isn't running
+    timer.step("connect to the keyboard server")
+
+    def dump_metrics():
+        slideclicker.metrics.dump()
+        return True  # keep handling the signal
+
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, dump_metrics)
+    metrics_server = None
+    if args.metrics_socket is not None:
+        metrics_server = slideclicker.metrics.MetricsServer(args.metrics_socket or None)
+        metrics_server.start()
+        timer.step("start the metrics server")
 
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     profile = register_profile(DBUS_PATH, BT_UUID, Watcher)
+    timer.step("register the bluetooth profile")
     mainloop = GLib.MainLoop()
     try:
         mainloop.run()
     finally:
         profile.Release()  # make sure all file descriptors are closed
+        if metrics_server is not None:
+            metrics_server.stop()
 
 
 if __name__ == "__main__":
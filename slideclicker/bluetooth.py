@@ -17,89 +17,447 @@
 
 """ Bluetooth server implementation for slideclicker """
 
-import os
 import time
 import json
 import logging
-from time import sleep
 from gi.repository import GLib
+from . import metrics
 from .kbd_client import KeyboardClient
-from .bluetooth_server import IOWatcher
-from .screenshot import take_screenshot
-from .wifi import upgrade_connection
+from .bluetooth_server import IOWatcher, ReceiveBuffer
+from .screenshot import (service, encode_delta, variant, QualityController, TIERS,
+                         TokenBucket, slide_changed)
 
 kbd = KeyboardClient()
 
 logger = logging.getLogger("bluetooth")
 
 WIFI_UPGRADE_ENABLED = False  # Set this to True to enable upgrading to Wifi
+# Set this to True to follow every low resolution screenshot with a better
+# one. Clients can also ask for this with "progressive": true in their hello
+PROGRESSIVE_ENABLED = False
+# Refinements can take this many times longer than the latency budget
+REFINEMENT_BUDGET = 4
+
+COMMAND_SIZE = 2  # all commands are two bytes, e.g. b"up"
+KNOWN_COMMANDS = (b"up", b"dn", b"pi", b"di", b"sc")
+MAX_HELLO_SIZE = 4096
+
+
+def _object_end(text):
+    """ Return the index just past the } that closes the { text starts
+        with, or None if it's not there yet. Doesn't care if what's in
+        between is valid JSON """
+    depth = 0
+    in_string = escaped = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return index + 1
+    return None
+
+
+def parse_hello(data):
+    """ Parse the hello message (a JSON object) from the start of data.
+
+        Returns a tuple of (client_info, size in bytes), or (None, None) if
+        the message isn't complete yet. If it's not valid JSON, client_info
+        is None and size is how much of data to skip (0 if it doesn't even
+        look like a hello). The app has been known to send invalid JSON, e.g.
+        with an unquoted "<unknown ssid>" """
+    raw = bytes(data)
+    try:
+        text = raw.decode()
+    except UnicodeDecodeError as e:
+        text = raw[:e.start].decode()  # probably a partial character at the end
+    stripped = text.lstrip()
+    if not stripped:
+        return None, None
+    if not stripped.startswith("{"):
+        return None, 0  # no hello, just commands
+    leading = len(text) - len(stripped)
+    try:
+        client_info, end = json.JSONDecoder().raw_decode(stripped)
+    except ValueError:
+        end = _object_end(stripped)
+        if end is None:
+            # either it's incomplete, or it's junk we can't find the end of
+            return None, None
+        # it's complete, and it's not valid JSON. Skip it
+        return None, len(text[:leading + end].encode())
+    if not isinstance(client_info, dict):
+        client_info = None
+    return client_info, len(text[:leading + end].encode())
+
+
+def parse_display(value):
+    """ Return the "display": [width, height] from the hello message as a
+        tuple, or None if it's not two positive integers """
+    if not isinstance(value, (list, tuple)) or len(value) != 2:
+        return None
+    # bool is an int too, but true isn't a size
+    if not all(type(n) is int and n > 0 for n in value):
+        return None
+    return tuple(value)
+
+
+def with_delta(f, base):
+    """ Return (f, f encoded as a delta against the base image, or None if
+        that's not smaller than f). This runs on the screenshot pool, it's
+        as slow as encoding """
+    if f.image is None:
+        return f, None
+    delta = encode_delta(base, f.image)
+    if delta is not None and len(delta) >= len(f.data):
+        return f, None  # the whole thing is cheaper
+    return f, delta
+
+
+class ScreenshotScheduler(object):
+    """ Decides when a connection's screenshot requests actually run.
+
+        Only one screenshot per connection is in progress at a time. Requests
+        that come in meanwhile are collapsed into the latest one, which runs
+        when the current one is done, and everything is rate limited with a
+        token bucket. Clicking quickly through a deck gets the final slide,
+        instead of a queue of every slide on the way there.
+
+        start is called with the request's arguments, and must call done()
+        when the screenshot is finished (or dropped) """
+    def __init__(self, start, bucket=None):
+        self.start = start
+        self.bucket = bucket or TokenBucket()
+        self.busy = False
+        self.pending = None  # arguments of the request waiting to run
+        self.pending_cost = 0
+        self.timer = None  # GLib source waiting for the bucket to refill
+        self.superseded = 0
+
+    def request(self, *args, cost=1):
+        """ Run a screenshot request, now or once the current one is done.
+            Replaces a request that's still waiting """
+        if self.pending is not None:
+            self.superseded += 1
+            logger.debug("screenshot request superseded (%d so far)", self.superseded)
+        self.pending = args
+        self.pending_cost = cost
+        self._run()
+
+    def done(self):
+        self.busy = False
+        self._run()
+
+    def _run(self):
+        if self.busy or self.pending is None or self.timer is not None:
+            return
+        wait = self.bucket.take(self.pending_cost)
+        if wait > 0:
+            logger.debug("rate limited, screenshot delayed by %.2fs", wait)
+            self.timer = GLib.timeout_add(int(wait * 1000) + 1, self._refilled)
+            return
+        args, self.pending = self.pending, None
+        self.busy = True
+        self.start(*args)
+
+    def _refilled(self):
+        self.timer = None
+        self._run()
+        return False  # don't call us again
+
+    def cancel(self):
+        """ Forget the waiting request, for when the connection closes """
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        self.pending = None
 
 
 class Watcher(IOWatcher):
     def __init__(self, fd, path):
         super().__init__(fd, path)
-        self.last_ping_time = time.time()
         self.got_hello = False
+        self.buffer = ReceiveBuffer()
         self.http_server = None
-        GLib.timeout_add_seconds(5, self.ping_checker)
+        self.progressive = PROGRESSIVE_ENABLED
+        self.delta = False  # can the client handle dlt: messages?
+        self.last_sent_image = None  # what the client is showing right now
+        self.quality = QualityController()
+        # bumped on every slide change or screenshot request, so we can tell
+        # when a screenshot that's still in progress is no longer wanted
+        self.screenshot_generation = 0
+        self.scheduler = ScreenshotScheduler(self._start_screenshot)
+        self.connected_at = time.monotonic()
+        self.received_at = None  # when the commands we're handling arrived
+        self.last_ping = None
+        metrics.connections.inc("bluetooth")
+        # Dead connections are closed by the profile's IdleTimeouts
 
-    def ping_checker(self):
-        """ Stop the connection if there's no activity for 11 seconds """
-        if time.time() - self.last_ping_time > 11:
-            logger.info("11 seconds with no activity, closing connection")
-            self.stop()
+    def prerender_screenshot(self):
+        """ Start rendering the screenshot the client is about to ask for """
+        if self.http_server is None:
+            service.prerender(tier=self.quality.tier())
+        else:
+            # the client will get the screenshot over wifi
+            service.prerender()
 
-    def send_screenshot(self, fd, hq=False):
-        f = take_screenshot(superlowres=not hq)
-        padded_len = str(len(f[0])).zfill(8)
-        msg = 'pic:%s' % padded_len
-        os.write(fd, msg.encode())
-        os.write(fd, f[0])
-        logger.debug("sent screenshot, %s bytes, hq=%s" % (len(f[0]), hq))
+    def refinement_tier(self):
+        """ The tier for the better screenshot in progressive mode """
+        if self.quality.throughput is None:
+            # nothing measured yet, use the regular size if it fits
+            return TIERS[self.quality.fit_display(TIERS.index(variant()))]
+        # the client already has something to look at, so we can afford
+        # to take longer
+        return self.quality.tier(budget=self.quality.budget * REFINEMENT_BUDGET)
+
+    def request_screenshot(self, hq=False, settle=True, fingerprint=None):
+        """ Ask the screenshot service for a screenshot, and send it to the
+            client once it's ready. This doesn't block the main loop.
+
+            The size and quality are picked by self.quality to fit the
+            connection. In progressive mode, the screenshot is followed by
+            a better one (hq) of the same frame (fingerprint), which is
+            dropped if the client moved on since.
+            Requests go through self.scheduler, so a burst of them is
+            collapsed into one and rate limited. """
+        if not hq:
+            # anything still in progress is outdated now
+            self.screenshot_generation += 1
+        # refinements were already paid for by the request they refine
+        self.scheduler.request(hq, settle, fingerprint, cost=0 if hq else 1)
+
+    def _start_screenshot(self, hq, settle, fingerprint):
+        if hq:
+            tier = self.refinement_tier()
+            future = service.refine(fingerprint, tier)
+        else:
+            tier = self.quality.tier()
+            future = service.request(settle=settle, tier=tier)
+        # The delta is encoded on the pool too, against what the client is
+        # showing now. send_screenshot() checks that's still true
+        base = self.last_sent_image if self.delta else None
+        if base is not None:
+            future = service.then(future, with_delta, base)
+        # The future completes on a worker thread, get back to the main loop
+        # before touching the connection
+        generation = self.screenshot_generation
+        future.add_done_callback(
+            lambda future: GLib.idle_add(self._screenshot_done, future, hq,
+                                         tier, generation, base))
+
+    def _screenshot_done(self, future, hq, tier, generation, base):
+        try:
+            self._send_finished_screenshot(future, hq, tier, generation, base)
+        finally:
+            # run the next request, if there's one waiting
+            self.scheduler.done()
+        return False  # don't call us again
+
+    def _send_finished_screenshot(self, future, hq, tier, generation, base):
+        if self.fd is None:
+            return  # connection was closed in the meantime
+        if generation != self.screenshot_generation:
+            logger.debug("dropping outdated screenshot, hq=%s", hq)
+            return
+        try:
+            if base is None:
+                f, delta = future.result(), None
+            else:
+                f, delta = future.result()
+        except Exception:
+            logger.exception("Screenshot failed!")
+            return
+        if self.progressive and not hq and self.refinement_tier() != tier:
+            # Get the better one too: the same frame, encoded again, so no
+            # need to capture or wait for it. It's only queued after the
+            # preview, but asked for first, so by the time the client has
+            # the preview it's already decided
+            self.request_screenshot(hq=True, settle=False,
+                                    fingerprint=f.fingerprint)
+        try:
+            self.send_screenshot(self.fd, f, hq, tier, delta, base)
+        except Exception:
+            logger.exception("Screenshot failed!")
+
+    def send_screenshot(self, fd, f, hq=False, tier=None, delta=None, base=None):
+        """ Queue a screenshot. delta is f encoded as a dlt: against base
+            (see with_delta()), it's only sent if base is still what the
+            client is showing, and no other screenshot is on its way """
+        if delta is not None and (base is not self.last_sent_image or
+                                  self.is_pending("pic")):
+            delta = None
+        if delta is not None:
+            msg, data = 'dlt:', delta
+        else:
+            msg, data = 'pic:', f.data
+        padded_len = str(len(data)).zfill(8)
+        queued_at = time.perf_counter()
+
+        def sent():
+            self.last_sent_image = f.image
+            metrics.screenshots.inc("bluetooth", msg[:3])
+            # the kernel took it, now wait until it actually went out
+            self.when_delivered(delivered)
+
+        def delivered():
+            seconds = time.perf_counter() - queued_at
+            metrics.transfer_seconds.observe(seconds, "bluetooth")
+            if delta is None and tier in TIERS:
+                # deltas don't tell us how big a full screenshot would be
+                self.quality.record(TIERS.index(tier), len(data), seconds)
+
+        # a newer screenshot replaces an older one that wasn't sent yet
+        self.write((msg + padded_len).encode(), data, tag="pic", on_sent=sent)
+        logger.debug("queued screenshot, %s %s bytes, hq=%s", msg, len(data), hq)
 
     def send_str(self, fd, s):
-        os.write(fd, s.decode())
+        self.write(s.encode())
 
     def stop(self):
         logger.info("closing connection...")
+        self.scheduler.cancel()
+        if self.connected_at is not None:
+            metrics.connection_seconds.observe(time.monotonic() - self.connected_at,
+                                               "bluetooth")
+            metrics.connections.dec("bluetooth")
+            self.connected_at = None
         if self.http_server is not None:
             self.http_server.stop()
             self.http_server.join()
         super().stop()
 
+    def bytes_sent(self, count):
+        metrics.bytes_sent.inc("bluetooth", amount=count)
+
+    def idle_timeout(self):
+        metrics.idle_timeouts.inc()
+        super().idle_timeout()
+
     def hup_callback(self, fd, cond):
         logger.info("connection closed")  # overriding this just for the log
         super().hup_callback(fd, cond)
 
     def io_callback(self, fd, cond):
         logger.debug("io callback")
-        self.last_ping_time = time.time()
-        read_size = 2 if self.got_hello else 1024  # This is ugly
-        command = os.read(fd, read_size)
-        if not self.got_hello:
-            # this is a hello command, it's the wifi upgrade handshake
-            self.got_hello = True
-            if WIFI_UPGRADE_ENABLED:
-                self.http_server = upgrade_connection(fd, command)
-            return True
-        if command == b"up":
-            kbd.pageup()
-        elif command == b"dn":
-            kbd.pagedown()
+        self.received_at = time.perf_counter()
+        try:
+            count = self.buffer.fill(fd)
+        except BlockingIOError:
+            return True  # nothing to read after all
+        except OSError as e:
+            logger.error("reading from the connection failed: %s" % e)
+            count = 0
+        if count == 0:
+            logger.info("connection closed")
+            self.stop()
+            return False
+        # Consecutive key presses are sent to the keyboard server as a single
+        # batch, so a burst of clicks is one round trip
+        keys = []
+        for command, arg in self.parse_commands():
+            if command == "hello":
+                metrics.commands.inc("hello")
+            elif command in KNOWN_COMMANDS:
+                metrics.commands.inc(command.decode())
+            else:
+                metrics.commands.inc("unknown")  # don't make up labels from junk
+            if command == b"up" or command == b"dn":
+                if keys and keys[-1][0] == command:
+                    keys[-1] = (command, keys[-1][1] + 1)
+                else:
+                    keys.append((command, 1))
+                continue
+            self.send_keys(keys)
+            keys = []
+            self.handle_command(fd, command, arg)
+            if self.fd is None:
+                return True  # the command closed the connection
+        self.send_keys(keys)
+        return True
+
+    def send_keys(self, keys):
+        """ Send a list of (command, count) to the keyboard server """
+        if not keys:
+            return
+        slide_changed()  # don't share captures of the slide we're leaving
+        try:
+            kbd.send_batch(keys)
+        except Exception:
+            logger.exception("Sending keys to the keyboard server failed!")
+            return
+        self.screenshot_generation += 1  # cancel any refinement in progress
+        self.prerender_screenshot()
+
+    def parse_commands(self):
+        """ Decode all the complete commands waiting in the receive buffer.
+            Partial commands are left there until the rest of them arrives """
+        commands = []
+        offset = 0
+        with self.buffer.data() as data:
+            if not self.got_hello:
+                # The first message is a hello, it's the wifi upgrade handshake
+                client_info, offset = parse_hello(data)
+                if offset is None:
+                    if len(data) < MAX_HELLO_SIZE:
+                        return commands  # wait for the rest of it
+                    logger.error("hello message is too long, ignoring it")
+                    offset = len(data)
+                elif client_info is None:
+                    logger.error("did not understand the hello message, ignoring it: %r",
+                                 bytes(data[:offset]))
+                self.got_hello = True
+                commands.append(("hello", client_info))
+            while len(data) - offset >= COMMAND_SIZE:
+                commands.append((bytes(data[offset:offset + COMMAND_SIZE]), None))
+                offset += COMMAND_SIZE
+        self.buffer.consume(offset)
+        return commands
+
+    def handle_command(self, fd, command, client_info=None):
+        """ Handle a single command from the client (other than up/dn, which
+            are handled by send_keys()) """
+        if command == "hello":
+            if client_info is not None and client_info.get("progressive"):
+                self.progressive = True
+            if client_info is not None and client_info.get("delta"):
+                self.delta = True
+            if client_info is not None and client_info.get("display"):
+                # "display": [width, height] of the client's screen
+                display = parse_display(client_info["display"])
+                if display is None:
+                    logger.warning("ignoring invalid display size %r",
+                                   client_info["display"])
+                self.quality.display = display
+            if WIFI_UPGRADE_ENABLED and client_info is not None:
+                # imported here, libnm is slow to load and only needed for wifi
+                from .wifi import upgrade_connection
+                self.http_server = upgrade_connection(self.write, client_info)
         elif command == b"pi":
-            # got ping, sent pong
-            os.write(fd, b'pong')
+            # got ping, sent pong. This can go ahead of a queued screenshot
+            received_at = self.received_at
+            if self.last_ping is not None:
+                metrics.ping_interval_seconds.observe(received_at - self.last_ping)
+            self.last_ping = received_at
+
+            def sent():
+                metrics.pong_seconds.observe(time.perf_counter() - received_at)
+            self.write(b'pong', urgent=True, on_sent=sent)
         elif command == b'di':
             # disconnect command recieved
             logger.info("client sent a disconnect command")
             self.stop()
         elif command == b'sc':
             # screenshot requested
-            sleep(0.3)  # Sleep to give the slides time to change
-            try:
-                self.send_screenshot(fd)
-            except Exception as e:
-                logger.exception("Screenshot failed!")
+            self.request_screenshot()
         else:
             logger.error("did not understand command '%s'" % command)
-        return True
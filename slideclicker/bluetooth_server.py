@@ -22,12 +22,67 @@
 # export your own dbus object
 
 from gi.repository import GLib
+import fcntl
+import logging
 import os
+import socket
+import struct
+import termios
+import time
 import dbus
 import dbus.service
 import dbus.mainloop.glib
 from gi.repository import GObject
 
+logger = logging.getLogger("bluetooth_server")
+
+DRAIN_POLL_INTERVAL = 20  # ms, see IOWatcher.when_delivered()
+IDLE_TIMEOUT = 12  # seconds without activity before a connection is closed.
+# The android app pings every 10 seconds
+
+
+class ReceiveBuffer(object):
+    """ A reusable receive buffer for a file descriptor.
+
+        fill() reads whatever is available into the buffer, data() returns
+        what hasn't been consumed yet and consume() discards it once it was
+        parsed. Partial messages stay in the buffer until the rest of them
+        arrives. """
+    def __init__(self, size=4096):
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def fill(self, fd):
+        """ Read whatever is available from fd, return the number of bytes
+            read (0 means EOF) """
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buf):
+            # Out of room: move the leftovers to the front, and grow the
+            # buffer if they take all of it
+            leftover = self._end - self._start
+            self._buf[:leftover] = self._buf[self._start:self._end]
+            self._start, self._end = 0, leftover
+            if leftover == len(self._buf):
+                self._buf.extend(bytes(len(self._buf)))
+        with memoryview(self._buf) as view:
+            count = os.readv(fd, [view[self._end:]])
+        self._end += count
+        return count
+
+    def data(self):
+        """ Return the unconsumed data. Don't hold on to the returned
+            memoryview after calling fill() or consume() """
+        return memoryview(self._buf)[self._start:self._end]
+
+    def consume(self, count):
+        """ Mark count bytes as parsed """
+        self._start = min(self._start + count, self._end)
+
 
 class IOWatcher(object):
     """ Use this class to watch for IO on an fd, it calls a callback when
@@ -37,13 +92,141 @@ class IOWatcher(object):
         to handle incoming data, and then call start() to start watching
         for new data. Make sure to call stop() when you're done to close
         the fd and remove the watch.
+
+        Use write() to send data. The fd is non-blocking, so writes are queued
+        and sent whenever the fd is writable, without blocking the main loop.
         """
     def __init__(self, fd, path):
         self.fd = fd
         self.watch_id = None
         self.hup_watch = None
+        self.out_watch = None
         self.channel = None
         self.dbus_path = path
+        # list of (tag, [buffers], on_sent) waiting to be sent
+        self.out_queue = []
+        self._sending = None  # the message we're in the middle of sending
+        self._family = None  # socket family and send buffer size, for
+        self._sndbuf = None  # send_queue_empty()
+        # time.monotonic() of the last time we got data, or sent some
+        self.last_activity = time.monotonic()
+        self.on_stop = None  # called with this watcher once it's stopped
+
+    def write(self, *buffers, tag=None, urgent=False, on_sent=None):
+        """ Queue a message (made of one or more buffers) to be sent.
+
+            A message is never interleaved with other messages. If tag is
+            set, the new message replaces any message with the same tag that
+            hasn't started sending yet. urgent messages skip ahead of
+            everything that hasn't started sending yet.
+
+            on_sent is called with no arguments once the whole message was
+            handed to the kernel """
+        if self.fd is None:
+            return
+        message = (tag, [memoryview(buf).cast("B") for buf in buffers if len(buf)],
+                   on_sent)
+        if tag is not None:
+            self.out_queue = [queued for queued in self.out_queue
+                              if queued[0] != tag]
+        if urgent:
+            self.out_queue.insert(0, message)
+        else:
+            self.out_queue.append(message)
+        if self.out_watch is None and self._flush():
+            # couldn't send everything right now, wait until we can
+            self.out_watch = GLib.io_add_watch(self.channel,
+                                               GLib.PRIORITY_DEFAULT,
+                                               GLib.IO_OUT,
+                                               self._out_callback)
+
+    def _flush(self):
+        """ Send as much as we can without blocking. Returns True if
+            there's still data waiting to be sent """
+        while self.fd is not None:
+            if self._sending is None:
+                if not self.out_queue:
+                    return False
+                self._sending = self.out_queue.pop(0)
+            buffers = self._sending[1]
+            try:
+                sent = os.writev(self.fd, buffers)
+            except BlockingIOError:
+                return True
+            except OSError:
+                self.stop()  # connection is gone
+                return False
+            if sent:
+                self.bytes_sent(sent)
+                # RFCOMM has flow control, so this means the other side is
+                # still reading. It can't ping while it's getting a screenshot
+                self.last_activity = time.monotonic()
+            # Drop whatever was sent, without copying the rest
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers.pop(0))
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+            if not buffers:
+                on_sent = self._sending[2]
+                self._sending = None
+                if on_sent is not None:
+                    on_sent()
+        return False
+
+    def send_queue_empty(self):
+        """ Return True if the kernel sent everything we wrote, False if it
+            didn't yet, or None if it won't tell us """
+        if self._family is None:
+            return None
+        try:
+            result = fcntl.ioctl(self.fd, termios.TIOCOUTQ, struct.pack("i", 0))
+        except OSError:
+            return None
+        value = struct.unpack("i", result)[0]
+        if self._family == getattr(socket, "AF_BLUETOOTH", 31):
+            # Bluetooth sockets return the free space in the send buffer
+            # instead of what's in it
+            return value >= self._sndbuf
+        return value == 0
+
+    def when_delivered(self, callback):
+        """ Call callback (with no arguments) once everything written so far
+            has left the kernel's send queue, not just got into it. The send
+            queue can hold a whole screenshot, so on_sent doesn't say much
+            about how fast the connection is. Anything written later delays
+            it too, so it's on the slow side.
+
+            If the kernel doesn't tell us, callback is called right away """
+        def check():
+            if self.fd is None:
+                return False  # never mind
+            if self.send_queue_empty() is False:
+                return True  # still waiting, check again later
+            callback()
+            return False
+
+        if check():
+            GLib.timeout_add(DRAIN_POLL_INTERVAL, check)
+
+    def bytes_sent(self, count):
+        """ Called whenever count bytes were handed to the kernel, override
+            it to keep track """
+        pass
+
+    def is_pending(self, tag):
+        """ Check if a message with this tag is waiting to be sent, or in
+            the middle of being sent """
+        if self._sending is not None and self._sending[0] == tag:
+            return True
+        return any(queued[0] == tag for queued in self.out_queue)
+
+    def _out_callback(self, channel, cond):
+        if self._flush():
+            return True
+        self.out_watch = None
+        return False
 
     def stop(self):
         """ Stop the watcher and close the file descriptor """
@@ -55,6 +238,12 @@ class IOWatcher(object):
             GLib.source_remove(self.hup_watch)  # remove the watch
             self.hup_watch = None
 
+        if self.out_watch is not None:
+            GLib.source_remove(self.out_watch)
+            self.out_watch = None
+        self.out_queue = []
+        self._sending = None
+
         if self.channel is not None:
             self.channel.close()
             self.channel = None
@@ -66,9 +255,23 @@ class IOWatcher(object):
                 pass  # Don't care if it's already closed
             self.fd = None
 
+        if self.on_stop is not None:
+            on_stop, self.on_stop = self.on_stop, None
+            on_stop(self)
+
     def start(self):
         """ Set a GLib watch on the file descriptor """
-        print("starting watcher on fd " + str(self.fd))
+        logger.debug("starting watcher on fd %s" % self.fd)
+        os.set_blocking(self.fd, False)
+        try:
+            sock = socket.socket(fileno=self.fd)
+            try:
+                self._family = sock.family
+                self._sndbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+            finally:
+                sock.detach()  # the fd is still ours
+        except (OSError, ValueError):
+            pass  # not a socket, when_delivered() can't do much
         channel = GLib.IOChannel.unix_new(self.fd)
         self.channel = channel
 
@@ -80,16 +283,20 @@ class IOWatcher(object):
                                            GLib.PRIORITY_DEFAULT,
                                            GLib.IO_HUP,
                                            self.hup_callback)
-        print(self.watch_id)
 
     def _callback_wrapper(self, channel, cond):
         if self.watch_id is None:
             # Don't call user callback if we just closed this watcher
             return False
 
+        self.last_activity = time.monotonic()
         fd = channel.unix_get_fd()
         return self.io_callback(fd, cond)
 
+    def idle_timeout(self):
+        """ Called by IdleTimeouts when there was no activity for too long """
+        self.stop()
+
     def hup_callback(self, fd, cond):
         """ Called by glib when we get HUP on the fd """
         self.stop()
@@ -100,34 +307,102 @@ class IOWatcher(object):
                                   "you need to override this in a subclass.")
 
 
+class IdleTimeouts(object):
+    """ Stop connections that have been quiet for more than deadline
+        seconds, using one GLib timer for all of them.
+
+        Watchers keep track of their own last_activity, so activity costs
+        nothing here. The timer is set for the earliest deadline, and when
+        it fires, connections that were active since then are pushed back
+        to their new deadline, and the others are stopped. """
+    def __init__(self, deadline=None):
+        self.deadline = deadline or IDLE_TIMEOUT
+        self.watchers = set()
+        self._timer = None
+
+    def add(self, watcher):
+        self.watchers.add(watcher)
+        if self._timer is None:
+            self._schedule()
+        # otherwise the timer is for an earlier deadline than this one
+
+    def remove(self, watcher):
+        self.watchers.discard(watcher)
+        if not self.watchers:
+            self._cancel()
+
+    def _cancel(self):
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+
+    def _schedule(self):
+        self._cancel()
+        if not self.watchers:
+            return
+        earliest = min(watcher.last_activity for watcher in self.watchers)
+        wait = earliest + self.deadline - time.monotonic()
+        self._timer = GLib.timeout_add(max(0, int(wait * 1000)) + 1, self._check)
+
+    def _check(self):
+        self._timer = None
+        now = time.monotonic()
+        for watcher in list(self.watchers):
+            if now - watcher.last_activity >= self.deadline:
+                logger.info("%s seconds with no activity on %s, closing it" %
+                            (self.deadline, watcher.dbus_path))
+                self.watchers.discard(watcher)
+                watcher.idle_timeout()
+        self._schedule()
+        return False  # _schedule() added a new timer, if it's still needed
+
+    def stop(self):
+        self.watchers.clear()
+        self._cancel()
+
+
 class BluezProfile(dbus.service.Object):
     def __init__(self, watcher_class, conn=None, object_path=None, bus_name=None):
         super().__init__(conn, object_path, bus_name)
         self.fd = None
         self.watcher_class = watcher_class
         self.connections = {}
+        self.idle_timeouts = IdleTimeouts()
 
     @dbus.service.method("org.bluez.Profile1", in_signature="oha{sv}")
     def NewConnection(self, path, fd, properties):
         """ Called when a new connection is established """
         self.fd = fd.take()
-        print("Connection established!")
+        logger.info("Connection established!")
+        old = self.connections.get(path)
+        if old is not None:
+            old.stop()  # the device reconnected without telling us first
         watcher = self.watcher_class(self.fd, path)
+        watcher.on_stop = self.connection_stopped
         watcher.start()
         self.connections[path] = watcher
+        self.idle_timeouts.add(watcher)
+
+    def connection_stopped(self, watcher):
+        """ Forget about a connection, however it ended """
+        if self.connections.get(watcher.dbus_path) is watcher:
+            del self.connections[watcher.dbus_path]
+        self.idle_timeouts.remove(watcher)
 
     @dbus.service.method("org.bluez.Profile1", in_signature="o")
     def RequestDisconnection(self, path):
         """ Handle disconnection """
-        connection = self.connections.pop(path)
-        connection.stop()
+        connection = self.connections.get(path)
+        if connection is not None:
+            connection.stop()  # connection_stopped() forgets about it
 
     @dbus.service.method("org.bluez.Profile1")
     def Release(self):
         """ Called when the service daemon unregisters the profile """
-        print("bye")
-        for connection in self.connections.values():
+        logger.info("bye")
+        for connection in list(self.connections.values()):
             connection.stop()
+        self.idle_timeouts.stop()
 
 
 def register_profile(dbus_path, uuid, watcher_class):
@@ -142,5 +417,5 @@ def register_profile(dbus_path, uuid, watcher_class):
                                               "RequireAuthentication": True,
                                               "RequireAuthorization": True,
                                               "AutoConnect": True})
-    print("registered, waiting for connections")
+    logger.info("registered, waiting for connections")
     return profile
@@ -18,8 +18,10 @@
 
 """ A simple client for the fake-keyboard server """
 
+import json
 import socket
 import os
+import sys
 import logging
 from time import sleep
 SOCKET_PATH = '/run/slideclicker_socket'
@@ -28,31 +30,120 @@ logger = logging.getLogger("kbd_client")
 
 
 class KeyboardClient(object):
+    """ A client for the keyboard server.
+
+        Commands are sent as lines of "<command> <count> <sequence>\n", and
+        the server acknowledges each one with "ok <sequence>\n" (or "bad").
+        Several commands can be sent in one go with send_batch(), and we
+        don't wait for the acknowledgements, they're collected whenever we
+        send something. If the server restarts, we reconnect. """
     def __init__(self):
-        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket = None
+        self.sequence = 0
+        self.unacked = {}  # sequence -> (command, count)
+        self._acks = b""
+        # connected on first use (or call connect() to fail early)
+
+    def connect(self):
         if not os.path.exists(SOCKET_PATH):
             raise Exception("Socket doesn't exist, is the server running?")
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.socket.connect(SOCKET_PATH)
+        self._acks = b""
+        if self.unacked:
+            logger.warning("%s commands were not acknowledged by the previous "
+                           "server" % len(self.unacked))
+            self.unacked.clear()
 
-    def _send(self, what):
-        if what != b"up" and what != b"dn":
-            raise Exception("Invalid command")
-        logger.info("sending pg%s" % what.decode())
-        self.socket.sendall(what)
+    def send_batch(self, commands):
+        """ Send a list of (command, count) tuples in a single write """
+        frames = []
+        batch = {}
+        for what, count in commands:
+            if what != b"up" and what != b"dn":
+                raise Exception("Invalid command")
+            self.sequence += 1
+            batch[self.sequence] = (what, count)
+            frames.append(b"%s %d %d\n" % (what, count, self.sequence))
+            logger.info("sending pg%s x%s", what.decode(), count)
+        data = b"".join(frames)
+        try:
+            if self.socket is None:
+                self.connect()
+            self.socket.sendall(data)
+        except OSError:
+            # The server probably restarted, try again once with a new connection
+            logger.warning("lost connection to the keyboard server, reconnecting")
+            self.close()
+            self.connect()
+            self.socket.sendall(data)
+        # only now, connect() would've counted this batch as lost
+        self.unacked.update(batch)
+        self.read_acks()
 
-    def pageup(self):
-        self._send(b"up")
+    def read_acks(self):
+        """ Collect whatever acknowledgements arrived, without waiting """
+        while self.socket is not None:
+            try:
+                data = self.socket.recv(4096, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError:
+                data = b""
+            if not data:
+                logger.warning("keyboard server closed the connection")
+                self.close()
+                break
+            *lines, self._acks = (self._acks + data).split(b"\n")
+            for line in lines:
+                status, sequence = line.split(b" ")[:2]
+                if status == b"stats":
+                    continue  # not an acknowledgement
+                command = self.unacked.pop(int(sequence), None)
+                if status != b"ok":
+                    logger.error("keyboard server rejected %s" % (command,))
+        return len(self.unacked)
 
-    def pagedown(self):
-        self._send(b"dn")
+    def _send(self, what, count=1):
+        self.send_batch([(what, count)])
+
+    def pageup(self, count=1):
+        self._send(b"up", count)
+
+    def pagedown(self, count=1):
+        self._send(b"dn", count)
 
     def close(self):
-        self.socket.close()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+def latency_stats():
+    """ Ask the keyboard server for its latency histogram (receiving a
+        command on the socket -> writing it to uinput, in seconds) """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+        sock.sendall(b"st 1 1\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data.split(b" ", 2)[2].decode())
+
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["stats"]:
+        print(json.dumps(latency_stats(), indent=4))
+        sys.exit()
     # temporary test
     print("Connecting")
     kbd = KeyboardClient()
+    kbd.connect()
     print("Sleeping so you can open evince")
     sleep(5)
     kbd.pagedown()
@@ -21,31 +21,129 @@
     is a "service" and not done in the main process"""
 import uinput
 import asyncio
+import bisect
+import json
+import logging
 import os
 import pwd
 import grp
+import queue
+import threading
+import time
 SOCKET_PATH = '/run/slideclicker_socket'
 
+logger = logging.getLogger("kbd_server")
+
 
 class FakeKeyboard(object):
     """ Our fake keyboard. It only has two keys: pageup and pagedown """
     def __init__(self):
         self.device = uinput.Device([uinput.KEY_PAGEDOWN, uinput.KEY_PAGEUP])
 
-    def pageup(self):
-        """ Emit a pageup keypress """
-        print("pgup")
-        self.device.emit_click(uinput.KEY_PAGEUP)
+    def click(self, keys):
+        """ Emit clicks for a list of (key, count), with a single SYN at the end """
+        for key, count in keys:
+            for i in range(count):
+                self.device.emit(key, 1, syn=False)
+                self.device.emit(key, 0, syn=False)
+        self.device.syn()
+
+    def pageup(self, count=1):
+        """ Emit pageup keypresses """
+        self.click([(uinput.KEY_PAGEUP, count)])
 
-    def pagedown(self):
-        """ Emit a pagedown keypress """
-        print("pgdn")
-        self.device.emit_click(uinput.KEY_PAGEDOWN)
+    def pagedown(self, count=1):
+        """ Emit pagedown keypresses """
+        self.click([(uinput.KEY_PAGEDOWN, count)])
 
     def close(self):
         self.device.destroy()
 
 
+class Histogram(object):
+    """ A fixed-bucket latency histogram, in seconds """
+    BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+              0.005, 0.01, 0.025, 0.05, 0.1)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        with self._lock:
+            self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """ Upper bound of the bucket the given percentile falls in
+            (0 if there's nothing in the histogram yet) """
+        with self._lock:
+            if not self.count:
+                return 0
+            target = self.count * percent / 100
+            seen = 0
+            for bound, count in zip(self.BOUNDS, self.buckets):
+                seen += count
+                if seen >= target:
+                    return bound
+            return self.max
+
+    def as_dict(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else 0,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p99": self.percentile(99),
+                "buckets": dict(zip([str(b) for b in self.BOUNDS] + ["inf"],
+                                    self.buckets))}
+
+
+class Emitter(threading.Thread):
+    """ Emit key presses on a dedicated thread, so writing to uinput never
+        waits behind socket handling.
+
+        Everything that's queued by the time we get to it is emitted as one
+        batch with a single SYN. `latency` measures the time from receiving a
+        command on the socket to writing it to uinput. """
+    def __init__(self, keyboard):
+        super().__init__(daemon=True)
+        self.keyboard = keyboard
+        self.queue = queue.Queue()
+        self.latency = Histogram()
+
+    def submit(self, key, count, received_at):
+        self.queue.put((key, count, received_at))
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False  # stop() was called, but emit what we have first
+                batch = [item for item in batch if item is not None]
+            if not batch:
+                continue
+            self.keyboard.click([(key, count) for key, count, _ in batch])
+            emitted_at = time.perf_counter()
+            for _, _, received_at in batch:
+                self.latency.record(emitted_at - received_at)
+            logger.debug("emitted %s keys" % len(batch))
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
 def drop_privilages():
     # Get the uid/gid from the name
     running_uid = pwd.getpwnam("nobody").pw_uid
@@ -62,30 +160,63 @@ def drop_privilages():
     os.umask(0o022)
 
 kbd = None
+emitter = None
+
+MAX_COUNT = 100  # nobody needs to skip more slides than this in one go
+
+
+def handle_command(line, received_at):
+    """ Handle a "<command> <count> <sequence>" line, return the reply
+
+    "st 1 <sequence>" is a control command, it replies with
+    "stats <sequence> <json>" where json is the latency histogram """
+    try:
+        command, count, sequence = line.split(b" ")
+        count = int(count)
+        sequence = int(sequence)
+    except ValueError:
+        return b"bad 0\n"
+    if not 0 < count <= MAX_COUNT:
+        return b"bad %d\n" % sequence
+    if command == b"up":
+        emitter.submit(uinput.KEY_PAGEUP, count, received_at)
+    elif command == b"dn":
+        emitter.submit(uinput.KEY_PAGEDOWN, count, received_at)
+    elif command == b"st":
+        stats = json.dumps(emitter.latency.as_dict()).encode()
+        return b"stats %d %s\n" % (sequence, stats)
+    else:
+        return b"bad %d\n" % sequence
+    return b"ok %d\n" % sequence
+
 
 async def handle_messages(reader, writer):
     """ Process messages from the client """
-    running = True
-    while running:
-        command = await reader.read(2)
-        print(command)
-        if command == b"up":
-            kbd.pageup()
-        elif command == b"dn":
-            kbd.pagedown()
-        elif command == b"":
-            print("client disconnected")
-            running = False
+    pending = b""
+    while True:
+        data = await reader.read(4096)
+        received_at = time.perf_counter()
+        if data == b"":
+            logger.info("client disconnected")
             writer.close()
-        else:
-            writer.write(b"bad")
+            break
+        # Handle every complete command we got, keep the rest for later
+        *lines, pending = (pending + data).split(b"\n")
+        if len(pending) > 4096:
+            pending = b""  # that's not a command, it's junk
+        replies = [handle_command(line, received_at) for line in lines]
+        if replies:
+            writer.write(b"".join(replies))
             await writer.drain()
 
 
 def start_server():
     """ Start the server, and listen to requests until interrupted """
-    global kbd
+    global kbd, emitter
+    logging.basicConfig(level=logging.INFO)
     kbd = FakeKeyboard()
+    emitter = Emitter(kbd)
+    emitter.start()
     loop = asyncio.get_event_loop()
     coro = asyncio.start_unix_server(handle_messages, SOCKET_PATH, loop=loop)
     server = loop.run_until_complete(coro)
@@ -97,6 +228,7 @@ def start_server():
         server.close()
         loop.run_until_complete(server.wait_closed())
         loop.close()
+        emitter.stop()
         kbd.close()
         os.remove(SOCKET_PATH)
         print("bye")
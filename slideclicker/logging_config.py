@@ -14,27 +14,97 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-""" Logging functionality for slideclicker """
+""" Logging functionality for slideclicker
 
+Logging calls only put the record on a queue. The file and the console are
+written by a QueueListener on its own thread, so a slow disk or terminal
+never holds up the GLib main loop (and with it, a slide change).
+
+Chatty call sites (like one log line per keypress) are sampled: each one
+gets SAMPLE_BURST records per SAMPLE_INTERVAL seconds, and the next record
+that gets through says how many were dropped. Warnings and errors are
+never dropped. """
+
+import atexit
 import logging
+import logging.handlers
+import queue
+import threading
+import time
 
 fomatstr = '%(asctime)s : %(name)s: %(levelname)s: %(message)s'
 datefmt = "%Y-%m-%d %H:%M:%S"
 
-logging.basicConfig(level=logging.INFO,
-                    format=fomatstr,
-                    datefmt=datefmt,
-                    filename="slideclicker.log")
+SAMPLE_INTERVAL = 10  # seconds
+SAMPLE_BURST = 20  # records per call site per interval
+
+
+class SampleFilter(logging.Filter):
+    """ Let through at most burst records from each call site (logger and
+        line) every interval seconds, below warning level """
+    def __init__(self, interval=SAMPLE_INTERVAL, burst=SAMPLE_BURST):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._sites = {}  # (name, pathname, lineno) -> [window start, seen]
+        self._lock = threading.Lock()  # we log from worker threads too
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        site = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            window = self._sites.get(site)
+            if window is None or now - window[0] >= self.interval:
+                dropped = 0 if window is None else max(0, window[1] - self.burst)
+                window = self._sites[site] = [now, 0]
+                if dropped:
+                    record.msg = "%s (%d similar messages dropped)" % (record.msg, dropped)
+            window[1] += 1
+            return window[1] <= self.burst
+
 
 formatter = logging.Formatter(fomatstr, datefmt=datefmt)
 
+file_handler = logging.FileHandler("slideclicker.log")
+file_handler.setFormatter(formatter)
+
 console = logging.StreamHandler()
 console.setLevel(logging.INFO)
 console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+
+log_queue = queue.Queue()  # unbounded, so logging never blocks
+queue_handler = logging.handlers.QueueHandler(log_queue)
+sampler = SampleFilter()
+queue_handler.addFilter(sampler)
+
+listener = logging.handlers.QueueListener(log_queue, file_handler, console,
+                                          respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)  # write out whatever is still queued
+
+root = logging.getLogger('')
+root.setLevel(logging.INFO)
+root.addHandler(queue_handler)
+
+
+def set_levels(spec):
+    """ Set log levels per subsystem (logger name) from a string like
+        "bluetooth=debug,screenshot=warning". A level without a name sets
+        the default for everything. Raises ValueError if it doesn't make sense """
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, level = item.rpartition("=")
+        level = level.strip().upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError("unknown log level '%s'" % level)
+        logging.getLogger(name.strip()).setLevel(level)
+        if logging.getLevelName(level) < console.level:
+            console.setLevel(level)  # or we'd still not see them
 
 
 def get(name):
     """ Alias for logging.getLogger(name) """
     return logging.getLogger(name)
-
@@ -0,0 +1,245 @@
+# metrics.py - counters and histograms for slideclicker
+#
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Counters and histograms, to see where the time goes during a talk
+without turning on debug logging.
+
+Everything is kept in memory, and can be read in the Prometheus text format
+from a Unix socket (see MetricsServer), or written to the log with dump().
+Recording is cheap (a lock and an addition), and safe from any thread. """
+
+import bisect
+import logging
+import os
+import socket
+import stat
+import threading
+
+logger = logging.getLogger("metrics")
+
+# Histogram bounds, in seconds
+LATENCY_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                  0.5, 1, 2.5, 5, 10)
+LIFETIME_BOUNDS = (1, 10, 60, 300, 900, 1800, 3600, 7200, 14400)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                             for name, value in zip(names, values))
+
+
+class Metric(object):
+    """ A named metric, with one value per combination of label values """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise Exception("%s needs labels %s" % (self.name, self.labels))
+        return tuple(labels)
+
+    def render(self):
+        """ Return this metric in the Prometheus text format """
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+            for key, value in values:
+                lines.extend(self._render_value(key, value))
+        return "\n".join(lines)
+
+    def _render_value(self, key, value):
+        return ["%s%s %s" % (self.name, _format_labels(self.labels, key), value)]
+
+
+class Counter(Metric):
+    """ A number that only goes up """
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ A number that goes up and down """
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """ A fixed-bucket histogram """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), bounds=LATENCY_BOUNDS):
+        super().__init__(name, help, labels)
+        self.bounds = bounds
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # buckets (not cumulative), count, sum
+                entry = self._values[key] = [[0] * (len(self.bounds) + 1), 0, 0.0]
+            entry[0][bisect.bisect_left(self.bounds, value)] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def _render_value(self, key, value):
+        buckets, count, total = value
+        lines = []
+        seen = 0
+        for bound, bucket in zip(self.bounds + ("+Inf",), buckets):
+            seen += bucket
+            labels = _format_labels(self.labels + ("le",), key + (bound,))
+            lines.append("%s_bucket%s %d" % (self.name, labels, seen))
+        labels = _format_labels(self.labels, key)
+        lines.append("%s_sum%s %s" % (self.name, labels, total))
+        lines.append("%s_count%s %d" % (self.name, labels, count))
+        return lines
+
+
+class Registry(object):
+    """ All the metrics we know about """
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Return all the metrics in the Prometheus text format """
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+
+commands = registry.add(Counter(
+    "slideclicker_commands_total", "Commands received from clients",
+    ["command"]))
+capture_seconds = registry.add(Histogram(
+    "slideclicker_capture_seconds",
+    "Time to capture the screen, including waiting for it to settle",
+    ["settle"]))
+encode_seconds = registry.add(Histogram(
+    "slideclicker_encode_seconds", "Time to downscale and encode a screenshot"))
+transfer_seconds = registry.add(Histogram(
+    "slideclicker_transfer_seconds",
+    "Time from queueing a screenshot until it was sent. Over bluetooth, "
+    "that's until it left the kernel's send queue",
+    ["transport"]))
+screenshots = registry.add(Counter(
+    "slideclicker_screenshots_sent_total", "Screenshots sent to clients",
+    ["transport", "kind"]))
+bytes_sent = registry.add(Counter(
+    "slideclicker_bytes_sent_total", "Bytes sent to clients", ["transport"]))
+pong_seconds = registry.add(Histogram(
+    "slideclicker_pong_seconds",
+    "Time from receiving a ping to sending the pong. This is our part of the "
+    "client's ping round trip"))
+ping_interval_seconds = registry.add(Histogram(
+    "slideclicker_ping_interval_seconds",
+    "Time between pings from the same client. Gaps mean a bad link",
+    bounds=LIFETIME_BOUNDS))
+connections = registry.add(Gauge(
+    "slideclicker_connections", "Open client connections", ["transport"]))
+idle_timeouts = registry.add(Counter(
+    "slideclicker_idle_timeouts_total",
+    "Connections closed because they were quiet for too long"))
+connection_seconds = registry.add(Histogram(
+    "slideclicker_connection_seconds", "How long client connections lasted",
+    ["transport"], bounds=LIFETIME_BOUNDS))
+
+
+def dump():
+    """ Write all the metrics to the log """
+    logger.info("metrics:\n%s" % registry.render())
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", "/tmp")
+    return os.path.join(runtime_dir, "slideclicker-metrics.sock")
+
+
+class MetricsServer(threading.Thread):
+    """ Serve the metrics on a Unix socket: every connection gets the
+        current metrics in the Prometheus text format, and is then closed.
+        Try `socat - UNIX-CONNECT:$XDG_RUNTIME_DIR/slideclicker-metrics.sock`
+
+        This runs on its own thread, so reading the metrics never touches
+        the GLib main loop """
+    def __init__(self, path=None):
+        super().__init__(daemon=True)
+        self.path = path or default_socket_path()
+        try:
+            mode = os.stat(self.path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise Exception("%s exists and is not a socket, not replacing it"
+                                % self.path)
+            os.unlink(self.path)  # left over from a previous run
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)  # only for us
+        try:
+            self.socket.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.socket.listen(4)
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                break  # stop() closed the socket
+            with conn:
+                try:
+                    conn.sendall(registry.render().encode())
+                except OSError:
+                    pass  # they went away, not our problem
+
+    def stop(self):
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -18,62 +18,929 @@
 """ Take a screenshot from gnome-shell, return it as a bytesIO object """
 
 import base64
+import hashlib
+import json
+import logging
+import mmap
 import os
 import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
-from PIL import Image
-from pydbus import SessionBus
+from . import metrics
+# PIL and pydbus are imported where they're used, so that importing this
+# module (and starting slideclicker) stays fast
 
-bus = SessionBus()
-sc = bus.get("org.gnome.Shell.Screenshot")
+logger = logging.getLogger("screenshot")
 
 
-def thumbnail(file_path, max_size, jpeg_quality):
-    """ return a thumbnail for a file with the given parameters """
-    img = Image.open(file_path)
-    img.thumbnail(max_size)
-    # Attempt saving as both JPEG and PNG, return the smaller of the two
-    dataJPG = BytesIO()
-    dataPNG = BytesIO()
+# What take_screenshot() returns. data is a bytes-like object (usually a
+# memoryview, send it as is), image is the downscaled PIL image the data was
+# encoded from, or None for full resolution screenshots. fingerprint is the
+# fingerprint of the frame it was taken from
+Screenshot = namedtuple("Screenshot", ["data", "mimetype", "image", "fingerprint"])
+Screenshot.__new__.__defaults__ = (None,)  # fingerprint, namedtuple(defaults=) is 3.7+
+
+
+class ScreenshotCache(object):
+    """ A small LRU cache of encoded screenshots.
+
+        Entries are keyed on a fingerprint of the captured frame plus the
+        thumbnail parameters, so asking for the same slide again (which is
+        what the client does after every keypress and reconnect) doesn't
+        re-encode it. """
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # screenshots are taken on worker threads
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the cached value for key, or None """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Store a value, evicting the least recently used entries """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = ScreenshotCache()
+
+
+def fingerprint(data):
+    """ A cheap content hash for a captured frame """
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _tmpfs_dir():
+    """ Find a RAM backed directory for gnome-shell to write screenshots to """
+    for directory in (os.environ.get("XDG_RUNTIME_DIR"), "/dev/shm"):
+        if directory and os.path.isdir(directory) and os.access(directory, os.W_OK):
+            return directory
+    return None  # let tempfile pick, it's probably on disk but it still works
+
+
+class Frame(object):
+    """ A single captured frame.
+
+        `data` is either an encoded image (PNG from gnome-shell) or, when
+        `mode` and `size` are set, raw pixels that can be handed to Pillow
+        without decoding anything. """
+    def __init__(self, data, mode=None, size=None):
+        self.data = data
+        self.mode = mode
+        self.size = size
+        self._fingerprint = None
+        self._image = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_raw(self):
+        return self.mode is not None
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self.data)
+        return self._fingerprint
+
+    def image(self):
+        """ Return the frame as a PIL Image. It's decoded once, and shared by
+            everyone who asks, so don't change it in place """
+        from PIL import Image
+        with self._lock:
+            if self._image is None:
+                if self.is_raw:
+                    self._image = Image.frombuffer(self.mode, self.size, self.data,
+                                                   "raw", self.mode, 0, 1)
+                elif isinstance(self.data, mmap.mmap):
+                    self.data.seek(0)
+                    self._image = Image.open(self.data)
+                else:
+                    self._image = Image.open(BytesIO(self.data))
+                self._image.load()
+            return self._image
+
+    def encoded(self):
+        """ Return the full resolution frame as (PNG bytes, mimetype) """
+        if self.is_raw:
+            data = BytesIO()
+            self.image().save(data, 'png')
+            return data.getbuffer(), "image/png"
+        return bytes(self.data), "image/png"
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+BOX_DOWNSCALE = False  # pre-shrink frames with Image.reduce(), see box_downscale()
+
+
+def box_downscale(frame, max_size):
+    """ Shrink a frame by a whole factor with a box (area) filter, and the
+        rest of the way with a normal resize.
+
+        Image.reduce() only averages blocks of pixels, which is a lot less
+        work than resampling the whole frame. Off by default until
+        benchmark.py --box-downscale says it's a win on real hardware.
+        Returns None when it's off, or the frame is too small to bother. """
+    if not BOX_DOWNSCALE:
+        return None
+    img = frame.image()
+    width, height = img.size
+    factor = int(max(width / max_size[0], height / max_size[1]))
+    if factor < 2:
+        return None
+    from PIL import Image
+    scale = min(max_size[0] / width, max_size[1] / height)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    # reduce() makes a new image, the frame's one is shared
+    return img.reduce(factor).resize(size, Image.BICUBIC)
+
+
+class CaptureBackend(object):
+    """ A source of screenshots. Subclass it and override capture() """
+    def capture(self):
+        """ Capture the screen and return a Frame """
+        raise NotImplementedError("Not implemented. "
+                                  "you need to override this in a subclass.")
+
+
+def parse_capture_target(spec):
+    """ Parse a capture target: "window" (the focused window), "screen"
+        (everything), "monitor:N" or "area:X,Y,WIDTH,HEIGHT".
+        Returns (target, argument) """
+    target, _, argument = spec.partition(":")
     try:
-        img.save(dataJPG, 'jpeg', progressive=True, optimize=True, quality=jpeg_quality)
-        img.save(dataPNG, 'png', optimize=True)
-        dataJPG.seek(0)
-        dataPNG.seek(0)
-        dataJPG_bytes = dataJPG.read()
-        dataPNG_bytes = dataPNG.read()
-        if len(dataPNG_bytes) > len(dataJPG_bytes):
-            return dataJPG_bytes, "image/jpeg"
-        else:
-            return dataPNG_bytes, "image/png"
-    finally:
-        dataJPG.close()
-        dataPNG.close()
+        if target in ("window", "screen") and not argument:
+            return target, None
+        if target == "monitor":
+            return target, int(argument)
+        if target == "area":
+            area = [int(value) for value in argument.split(",")]
+            if len(area) == 4 and area[2] > 0 and area[3] > 0:
+                return target, area
+    except ValueError:
+        pass
+    raise ValueError("invalid capture target '%s'" % spec)
+
+
+def monitor_area(index):
+    """ Return [x, y, width, height] of a monitor, using Gdk """
+    import gi
+    gi.require_version('Gdk', '3.0')
+    from gi.repository import Gdk
+    display = Gdk.Display.get_default()
+    monitor = display.get_monitor(index) if display is not None else None
+    if monitor is None:
+        raise ValueError("no monitor number %s" % index)
+    geometry = monitor.get_geometry()
+    return [geometry.x, geometry.y, geometry.width, geometry.height]
+
 
+CAPTURE_CONFIG = os.path.join(os.environ.get("XDG_CONFIG_HOME") or
+                              os.path.expanduser("~/.config"),
+                              "slideclicker", "capture.json")
 
-def take_screenshot(downscale=True, superlowres=False):
-    """ Take a screenshot from gnome-shell, return it as a tuple of (image_bytes, mimetype).
-    Result may be other PNG or JPEG, whatever is smaller for the current screenshot"""
-    tmpfile = tempfile.mkstemp(prefix="slideclicker_", suffix=".png")
-    os.close(tmpfile[0])  # we don't need the fd from mkstemp()
+
+def load_capture_target():
+    """ Return the saved capture target spec, or None """
     try:
+        with open(CAPTURE_CONFIG) as f:
+            return json.load(f)["target"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_capture_target(spec):
+    """ Remember a capture target spec for next time """
+    os.makedirs(os.path.dirname(CAPTURE_CONFIG), exist_ok=True)
+    with open(CAPTURE_CONFIG, "w") as f:
+        json.dump({"target": spec}, f)
+
+
+class ShellBackend(CaptureBackend):
+    """ Capture using the gnome-shell screenshot API.
+
+        target is "window" (the focused window, the default), "screen",
+        "monitor" (argument is the monitor number) or "area" (argument is
+        [x, y, width, height]), see parse_capture_target(). Capturing just
+        the slide means less to encode, decode and downscale.
+
+        gnome-shell only knows how to write a PNG to a path, so we give it a
+        path on tmpfs and mmap the result instead of reading it from disk. """
+    def __init__(self, directory=None, target="window", argument=None):
+        self.directory = directory or _tmpfs_dir()
+        self._proxy = None
+        if target == "monitor":
+            target, argument = "area", monitor_area(argument)
+        self.target = target
+        self.area = argument
+
+    def _capture_to(self, path):
         # Take a screenshot, with no border, cursor, or flash
-        result = sc.ScreenshotWindow(False, False, False, tmpfile[1])
-        if not result[0]:
-            raise Exception("Screenshot failed!")
-        if not downscale:
-            with open(tmpfile[1], 'rb') as f:
-                data = f.read()
-            return data, "image/png"
+        if self.target == "screen":
+            return self.proxy.Screenshot(False, False, path)
+        elif self.target == "area":
+            return self.proxy.ScreenshotArea(*self.area, False, path)
+        return self.proxy.ScreenshotWindow(False, False, False, path)
+
+    @property
+    def proxy(self):
+        """ The gnome-shell screenshot DBus object, connected on first use """
+        if self._proxy is None:
+            from pydbus import SessionBus
+            self._proxy = SessionBus().get("org.gnome.Shell.Screenshot")
+        return self._proxy
+
+    def capture(self):
+        fd, path = tempfile.mkstemp(prefix="slideclicker_", suffix=".png",
+                                    dir=self.directory)
+        os.close(fd)  # gnome-shell replaces the file, so this fd is useless
+        try:
+            result = self._capture_to(path)
+            if not result[0]:
+                raise Exception("Screenshot failed!")
+            with open(path, 'rb') as f:
+                # the mapping stays valid after the file is closed and removed
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # Delete the temporary screenshot file, it's not needed anymore
+            os.remove(path)
+        return Frame(data)
+
+
+class RawBackend(CaptureBackend):
+    """ Serve a fixed framebuffer of raw pixels, skipping PNG decoding.
+
+        Useful as a stand-in for gnome-shell; call set_frame() to change
+        the "slide". """
+    def __init__(self, data, size, mode="RGB"):
+        self.set_frame(data, size, mode)
+
+    def set_frame(self, data, size=None, mode=None):
+        self.data = data
+        self.size = size or self.size
+        self.mode = mode or self.mode
+
+    def capture(self):
+        return Frame(self.data, mode=self.mode, size=self.size)
+
+
+backend = ShellBackend()
+
+
+def set_backend(new_backend):
+    """ Replace the capture backend used by take_screenshot() """
+    global backend
+    backend = new_backend
+    cache.clear()
+
+
+PREDICT_SAMPLE_SIZE = (128, 72)
+
+
+class FormatSelector(object):
+    """ Decide if a thumbnail should be encoded as PNG or JPEG without
+        encoding it twice.
+
+        Slides are usually either flat colour text, where PNG wins, or photos,
+        where JPEG wins, and that's easy to tell from the pixels. When the
+        statistics aren't conclusive we fall back to encoding both and
+        remember which format won, so the next similar slide can skip that.
+
+        Every verify_every frames both formats are encoded anyway, to check
+        the prediction. After a wrong one the next frame is checked too, and
+        if the prediction is wrong max_misses times in a row we stop
+        trusting it, and go by which format usually wins instead, until a
+        check shows the prediction is right again.
+
+        Set `mode` to "both" to always encode both formats, like we used to.
+        """
+    def __init__(self, mode="predict", max_colors=256, verify_every=20,
+                 max_misses=2):
+        self.mode = mode
+        self.max_colors = max_colors
+        self.verify_every = verify_every
+        self.max_misses = max_misses
+        self.predictions = 0
+        self.misses = 0  # wrong predictions in a row
+        self.wins = {"png": 0, "jpeg": 0}
+
+    def predict(self, img):
+        """ Return "png", "jpeg", or None if we can't tell """
+        if img.getcolors(self.max_colors) is not None:
+            return "png"  # only a few colours, definitely a text slide
+        from PIL import Image, ImageFilter, ImageStat
+        # The rest is done on a small sample of the pixels (no blending, that
+        # would make up colours), so it's much cheaper than encoding
+        sample = img.convert("L").resize(PREDICT_SAMPLE_SIZE, Image.NEAREST)
+        histogram = sorted(sample.histogram(), reverse=True)
+        # Share of the pixels covered by the 16 most common shades.
+        # Anti-aliased text on a flat background is still mostly a few colours
+        flatness = sum(histogram[:16]) / (sample.width * sample.height)
+        if flatness > 0.8:
+            return "png"
+        edges = sample.filter(ImageFilter.FIND_EDGES)
+        edge_density = ImageStat.Stat(edges).mean[0] / 255
+        if flatness < 0.3 or edge_density < 0.05:
+            # Lots of colours, or smooth gradients: photo-like
+            return "jpeg"
+        return None
+
+    def remembered(self):
+        """ The format that usually wins for inconclusive slides, if any """
+        total = self.wins["png"] + self.wins["jpeg"]
+        if total < 4:
+            return None
+        for fmt, count in self.wins.items():
+            if count / total >= 0.75:
+                return fmt
+        return None
+
+    @property
+    def trusted(self):
+        return self.misses < self.max_misses
+
+    def choose(self, img):
+        """ Return a tuple of (format to encode as, or None to encode both,
+            and the prediction to pass to record() after encoding both) """
+        if self.mode == "both":
+            return None, None
+        self.predictions += 1
+        prediction = self.predict(img)
+        verify = self.verify_every and self.predictions % self.verify_every == 0
+        if verify or (self.misses and self.trusted and prediction is not None):
+            # check every once in a while (or right after a miss) that
+            # we're still right
+            return None, prediction
+        if self.trusted and prediction is not None:
+            return prediction, None
+        return self.remembered(), prediction
+
+    def record(self, winner, prediction=None):
+        """ Remember which format won a dual encode, and whether the
+            prediction (if there was one) got it right """
+        self.wins[winner] += 1
+        if prediction is None:
+            return
+        if prediction == winner:
+            if not self.trusted:
+                logger.info("format prediction is right again, trusting it")
+            self.misses = 0
+        else:
+            self.misses += 1
+            if self.misses == self.max_misses:
+                logger.info("format prediction was wrong %s times in a row, "
+                            "not trusting it for now" % self.misses)
+
+
+formats = FormatSelector()
+
+
+def _encode(img, fmt, jpeg_quality):
+    data = BytesIO()
+    if fmt == "jpeg":
+        img.save(data, 'jpeg', progressive=True, optimize=True, quality=jpeg_quality)
+    else:
+        img.save(data, 'png', optimize=True)
+    # a view of the encoder's output, instead of copying it into a bytes
+    return data.getbuffer(), "image/" + fmt
+
+
+def _shrink(img, max_size):
+    """ Like img.thumbnail(), but returns a new image instead of changing
+        img, which might be shared """
+    from PIL import Image
+    width, height = img.size
+    scale = min(max_size[0] / width, max_size[1] / height)
+    if scale >= 1:
+        return img
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return img.resize(size, Image.BICUBIC, reducing_gap=2.0)
+
+
+def thumbnail(img, max_size, jpeg_quality):
+    """ return a thumbnail for a PIL image with the given parameters """
+    img = _shrink(img, max_size)
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")  # JPEG can't do alpha
+    fmt, prediction = formats.choose(img)
+    if fmt is not None:
+        return Screenshot(*_encode(img, fmt, jpeg_quality), img)
+    # Attempt saving as both JPEG and PNG, return the smaller of the two
+    jpg = _encode(img, "jpeg", jpeg_quality)
+    png = _encode(img, "png", jpeg_quality)
+    if len(png[0]) > len(jpg[0]):
+        formats.record("jpeg", prediction)
+        return Screenshot(*jpg, img)
+    else:
+        formats.record("png", prediction)
+        return Screenshot(*png, img)
+
+
+DELTA_TILE_SIZE = 32
+DELTA_MAX_CHANGE = 0.5  # send a full frame if more than this share of tiles changed
+
+
+def changed_tiles(old, new, tile_size=DELTA_TILE_SIZE):
+    """ Compare two images of the same size tile by tile, return a list of
+        the (x, y) positions of the tiles that changed """
+    from PIL import Image, ImageChops
+    diff = ImageChops.difference(old, new).convert("L")
+    if diff.getbbox() is None:
+        return []  # nothing changed at all
+    columns = -(-new.width // tile_size)
+    rows = -(-new.height // tile_size)
+    # Mark every changed pixel, pad to a whole number of tiles, and shrink
+    # it so every pixel is the average of one tile: anything above zero is a
+    # changed tile. This does the comparison for all the tiles in one go
+    mask = Image.new("F", (columns * tile_size, rows * tile_size))
+    mask.paste(diff.point(lambda p: 255 if p else 0).convert("F"))
+    grid = mask.resize((columns, rows), Image.BOX)
+    return [(index % columns * tile_size, index // columns * tile_size)
+            for index, value in enumerate(grid.getdata()) if value > 0]
+
+
+def changed_regions(tiles, width, height, tile_size=DELTA_TILE_SIZE):
+    """ Merge changed tiles into a few rectangles (left, top, right, bottom):
+        one for every band of consecutive tile rows with changes in them,
+        as wide as the changes in that band. Every image we send has its own
+        header, so a few bigger ones beat lots of tiny ones """
+    regions = []
+    for y in sorted(set(y for _, y in tiles)):
+        columns = [x for x, tile_y in tiles if tile_y == y]
+        left, right = min(columns), max(columns) + tile_size
+        if regions and regions[-1][3] == y:
+            # continues the band above it
+            band = regions[-1]
+            regions[-1] = (min(band[0], left), band[1], max(band[2], right), y + tile_size)
+        else:
+            regions.append((left, y, right, y + tile_size))
+    return [(left, top, min(right, width), min(bottom, height))
+            for left, top, right, bottom in regions]
+
+
+def encode_delta(old, new, jpeg_quality=65, tile_size=DELTA_TILE_SIZE):
+    """ Encode only the parts of new that differ from old.
+
+        Returns the payload of a dlt: message, or None if a full frame makes
+        more sense (different sizes, or too much of the image changed).
+
+        Payload format: 4 digits of image count, and then for every image
+        4 digits of x, 4 digits of y, 8 digits of length and the encoded
+        image (PNG or JPEG), to be drawn at x, y. All the numbers are zero
+        padded ASCII """
+    if old is None or old.size != new.size or old.mode != new.mode:
+        return None
+    tiles = changed_tiles(old, new, tile_size)
+    total = -(-new.width // tile_size) * -(-new.height // tile_size)
+    if len(tiles) > total * DELTA_MAX_CHANGE:
+        return None
+    regions = changed_regions(tiles, new.width, new.height, tile_size)
+    parts = [str(len(regions)).zfill(4).encode()]
+    for box in regions:
+        region = new.crop(box)
+        data, _ = _encode(region, formats.predict(region) or "jpeg", jpeg_quality)
+        parts.append(b"%04d%04d%08d" % (box[0], box[1], len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+class FrameFeed(object):
+    """ Lets threads wait for new screenshots, so they can be pushed to
+        clients as soon as the slide changes without polling for them.
+
+        take_screenshot() publishes every screenshot it takes, but waiters
+        are only woken up when the picture actually changed. """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._latest = {}  # (max_size, jpeg_quality) -> (version, fingerprint, screenshot)
+        self._version = 0
+
+    def publish(self, variant, fingerprint, screenshot):
+        with self._condition:
+            latest = self._latest.get(variant)
+            if latest is not None and latest[1] == fingerprint:
+                return  # nothing new
+            self._version += 1
+            self._latest[variant] = (self._version, fingerprint, screenshot)
+            self._condition.notify_all()
+
+    def latest(self, variant):
+        """ Return (version, screenshot) of the latest screenshot, or (0, None) """
+        with self._condition:
+            latest = self._latest.get(variant)
+            if latest is None:
+                return 0, None
+            return latest[0], latest[2]
+
+    def wait(self, variant, version, timeout=None):
+        """ Wait for a screenshot newer than version. Returns
+            (version, screenshot), or (version, None) on timeout """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._latest.get(variant, (0,))[0] > version, timeout)
+            latest = self._latest.get(variant)
+            if latest is None or latest[0] <= version:
+                return version, None
+            return latest[0], latest[2]
+
+
+feed = FrameFeed()
+
+
+def variant(superlowres=False):
+    """ Return the (max_size, jpeg_quality) of downscaled screenshots """
+    # These numbers were selected for peformance reasons
+    if superlowres:
+        return (256, 144), 65
+    else:
+        return (512, 288), 65
+
+
+# Screenshot quality tiers for QualityController, as (max_size, jpeg_quality),
+# from the smallest. TIERS[1] and TIERS[3] are the same as variant(True)
+# and variant(False)
+TIERS = [((192, 108), 50), ((256, 144), 65), ((384, 216), 65),
+         ((512, 288), 65), ((768, 432), 75)]
+
+
+class QualityController(object):
+    """ Pick the best screenshot tier that can still be sent within a latency
+        budget, based on the throughput measured on the connection.
+
+        Call record() after every screenshot is sent. tier() only goes up
+        one step at a time, so a bad guess about a bigger tier costs one slow
+        screenshot at most. If the client told us its display size, we
+        never send anything wider than that. """
+    def __init__(self, budget=0.5, display=None, initial=1):
+        self.budget = budget  # seconds
+        self.display = display  # (width, height) or None
+        self.current = initial
+        self.throughput = None  # bytes per second, smoothed
+        self.sizes = {}  # tier index -> typical encoded size, smoothed
+
+    def record(self, tier, size, seconds):
+        """ A screenshot of the given tier (index) and size (in bytes) took
+            this many seconds to send """
+        seconds = max(seconds, 0.001)
+        self.sizes[tier] = _smooth(self.sizes.get(tier), size)
+        self.throughput = _smooth(self.throughput, size / seconds)
+        self.current = self.choose()
+
+    def expected_size(self, tier):
+        """ Guess how big a screenshot of this tier would be """
+        if tier in self.sizes:
+            return self.sizes[tier]
+        if not self.sizes:
+            return None
+        # scale from the closest tier we know, by number of pixels
+        known = min(self.sizes, key=lambda known: abs(known - tier))
+        pixels = lambda index: TIERS[index][0][0] * TIERS[index][0][1]
+        return self.sizes[known] * pixels(tier) / pixels(known)
+
+    def choose(self, budget=None):
+        """ Return the index of the best tier that fits the budget """
+        if budget is None:
+            budget = self.budget
+        if self.throughput is None:
+            return self.current
+        best = 0
+        for index in range(self.fit_display(len(TIERS) - 1) + 1):
+            if index > self.current + 1:
+                break  # don't jump more than one step up at a time
+            if self.expected_size(index) / self.throughput <= budget:
+                best = index
+        return best
+
+    def tier(self, budget=None):
+        """ The (max_size, jpeg_quality) to use for the next screenshot """
+        index = self.current if budget is None else self.choose(budget)
+        return TIERS[self.fit_display(index)]
+
+    def fit_display(self, index):
+        """ Return the index of the best tier up to TIERS[index] that's no
+            wider than the client's display (the smallest if none is) """
+        while (index > 0 and self.display is not None and
+               TIERS[index][0][0] > max(self.display)):
+            index -= 1
+        return index
+
+
+def _smooth(old, new, weight=0.3):
+    """ Exponentially weighted moving average """
+    return new if old is None else old + (new - old) * weight
+
+
+SETTLE_TIMEOUT = 1.0  # Maximum time to wait for the slide to change
+SETTLE_INTERVAL = 0.02  # between captures while the screen is changing
+SETTLE_MAX_INTERVAL = 0.2  # backed off to while it isn't
+# Give up once the screen looked the same as before the keypress for this
+# long, e.g. pagedown on the last slide doesn't change anything
+SETTLE_UNCHANGED_TIME = 0.4
+
+last_fingerprint = None  # fingerprint of the most recent capture
+
+
+def wait_for_settle(changed_from=None, timeout=None):
+    """ Capture frames in a loop until the screen stops changing.
+
+        Returns the first frame that's identical to the one captured right
+        before it, and different from `changed_from` (the fingerprint of
+        the frame before the slide was changed), or the latest frame if that
+        doesn't happen within the timeout, or if the screen stays the same as
+        `changed_from` for SETTLE_UNCHANGED_TIME.
+
+        Every capture is a full resolution PNG from gnome-shell (there's no
+        cheaper way to ask it), so the interval between captures doubles
+        while nothing changes, instead of hammering it in the middle of a
+        slide transition. """
+    if timeout is None:
+        timeout = SETTLE_TIMEOUT
+    start = time.monotonic()
+    deadline = start + timeout
+    interval = SETTLE_INTERVAL
+    previous = None
+    while True:
+        frame = backend.capture()
+        now = time.monotonic()
+        unchanged = previous is not None and frame.fingerprint == previous.fingerprint
+        settled = unchanged and frame.fingerprint != changed_from
+        if previous is not None:
+            previous.close()
+        if settled:
+            return frame
+        if now >= deadline:
+            logger.debug("screen did not settle after %ss" % timeout)
+            return frame
+        if (frame.fingerprint == changed_from and
+                now - start >= SETTLE_UNCHANGED_TIME):
+            logger.debug("screen did not change, not waiting any longer")
+            return frame
+        if unchanged:
+            interval = min(interval * 2, SETTLE_MAX_INTERVAL)
+        else:
+            interval = SETTLE_INTERVAL  # it's moving, keep a close eye on it
+        previous = frame
+        time.sleep(min(interval, max(0, deadline - now)))
+
+
+class FrameBroker(object):
+    """ Coalesce concurrent screenshot requests, from all the bluetooth
+        connections and wifi clients, into a single capture, and a single
+        encode per variant. Everyone gets the same (shared, don't change it)
+        result.
+
+        A request that comes in while a capture is in progress waits for that
+        capture instead of starting another one, as long as the capture
+        started after the last slide change (see slide_changed(), otherwise
+        it might be of the previous slide). The same goes for encoding the
+        same frame with the same parameters. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (settle, changed_from) -> (Future, start time) of the capture in progress
+        self._captures = {}
+        # cache key -> (Future, start time) of the encode in progress
+        self._encodes = {}
+        self.latest = None  # the last frame we captured
+        self.last_change = 0.0  # time.monotonic() of the last keypress
+
+    def slide_changed(self):
+        """ Call this before changing the slide: captures that are already
+            in progress won't be shared from now on """
+        self.last_change = time.monotonic()
+
+    def _join_or_start(self, jobs, key, not_before=None):
+        """ Return (future, True) if we should do the job, or (future, False)
+            if someone's already doing it (and started after not_before) """
+        with self._lock:
+            job = jobs.get(key)
+            if job is not None and (not_before is None or job[1] >= not_before):
+                return job[0], False
+            future = Future()
+            # later requests join this one instead of the older one
+            jobs[key] = (future, time.monotonic())
+            return future, True
+
+    def _run(self, jobs, key, future, function, *args):
+        try:
+            result = function(*args)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                if jobs.get(key, (None,))[0] is future:
+                    del jobs[key]
+        future.set_result(result)
+        return result
+
+    def capture(self, settle=False, changed_from=None):
+        """ Return a Frame, sharing a capture that's already in progress if
+            it started after the last slide change """
+        key = (settle, changed_from if settle else None)
+        future, owner = self._join_or_start(self._captures, key, self.last_change)
+        if not owner:
+            return future.result()
+        start = time.perf_counter()
+        if settle:
+            frame = self._run(self._captures, key, future, wait_for_settle,
+                              changed_from)
         else:
-            # These numbers were selected for peformance reasons
-            if superlowres:
-                max_size = (256, 144)
-                jpeg_quality = 65
-            else:
-                max_size = (512, 288)
-                jpeg_quality = 65
-            return thumbnail(tmpfile[1], max_size, jpeg_quality)
-    finally:
-        # Delete the temporary screenshot file, it's not needed anymore
-        os.remove(tmpfile[1])
+            frame = self._run(self._captures, key, future, backend.capture)
+        self.latest = frame
+        metrics.capture_seconds.observe(time.perf_counter() - start,
+                                        "true" if settle else "false")
+        return frame
+
+    def encode(self, frame, max_size, jpeg_quality):
+        """ Return a Screenshot of frame, from the cache, an encode that's
+            already in progress, or a new encode """
+        key = (frame.fingerprint, max_size, jpeg_quality)
+        result = cache.get(key)
+        if result is not None:
+            return result
+        future, owner = self._join_or_start(self._encodes, key)
+        if not owner:
+            return future.result()
+        return self._run(self._encodes, key, future, self._encode, frame,
+                         max_size, jpeg_quality, key)
+
+    def _encode(self, frame, max_size, jpeg_quality, key):
+        result = cache.get(key)  # someone might have just finished it
+        if result is None:
+            start = time.perf_counter()
+            img = box_downscale(frame, max_size)
+            if img is None:
+                img = frame.image()
+            result = thumbnail(img, max_size, jpeg_quality)
+            result = result._replace(fingerprint=frame.fingerprint)
+            metrics.encode_seconds.observe(time.perf_counter() - start)
+            cache.put(key, result)
+        return result
+
+
+broker = FrameBroker()
+
+
+def slide_changed():
+    """ Tell the screenshot code that we're about to change the slide """
+    broker.slide_changed()
+
+
+def take_screenshot(downscale=True, superlowres=False, settle=False, changed_from=None,
+                    tier=None):
+    """ Take a screenshot from gnome-shell, return it as a Screenshot tuple of (image_bytes, mimetype, image).
+    Result may be other PNG or JPEG, whatever is smaller for the current screenshot
+
+    If settle is True, wait for the screen to stop changing first (see wait_for_settle())
+    tier is a (max_size, jpeg_quality) tuple (see TIERS), overriding superlowres
+
+    Concurrent calls share their capture and encoding (see FrameBroker) """
+    global last_fingerprint
+    # The frame might be shared with other threads, so it's not closed here.
+    # Its buffer is released once nobody's using it anymore
+    frame = broker.capture(settle, changed_from)
+    # gnome-shell encodes the same pixels to the same PNG, so hashing
+    # the capture is enough to tell if the slide changed
+    last_fingerprint = frame.fingerprint
+    if not downscale:
+        return Screenshot(*frame.encoded(), None, frame.fingerprint)
+    max_size, jpeg_quality = tier or variant(superlowres)
+    result = broker.encode(frame, max_size, jpeg_quality)
+    feed.publish((max_size, jpeg_quality), frame.fingerprint, result)
+    return result
+
+
+def reencode_screenshot(fingerprint, tier):
+    """ Encode the frame with the given fingerprint again, with a different
+        tier, without capturing it again. If it's no longer the latest frame
+        we captured, take a new screenshot instead """
+    frame = broker.latest
+    if frame is None or frame.fingerprint != fingerprint:
+        return take_screenshot(settle=False, tier=tier)
+    max_size, jpeg_quality = tier
+    result = broker.encode(frame, max_size, jpeg_quality)
+    feed.publish(tier, fingerprint, result)
+    return result
+
+
+PRERENDER_MAX_AGE = 2  # seconds
+
+
+class ScreenshotService(object):
+    """ Take screenshots on a pool of worker threads, so that capturing and
+        encoding never blocks the GLib main loop (and with it, keypresses).
+
+        request() returns a concurrent.futures.Future. prerender() starts
+        taking a screenshot as soon as the slide is changed, so the request
+        that follows a keypress is answered from an already finished (or at
+        least already started) result.
+
+        Only the newest prerender is kept, and only until the next request,
+        or for PRERENDER_MAX_AGE seconds, whichever comes first. An older
+        one could be of a slide that's long gone. """
+    def __init__(self, workers=4):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._prerendered = None  # (key, future, time it was started)
+        self._lock = threading.Lock()
+
+    def prerender(self, downscale=True, superlowres=False, tier=None):
+        """ Start rendering a screenshot of the slide we just changed to """
+        key = (downscale, superlowres, tier)
+        # remember what the screen looked like before the keypress,
+        # so we can tell when the new slide is up
+        future = self._executor.submit(take_screenshot, downscale, superlowres,
+                                       settle=True, changed_from=last_fingerprint,
+                                       tier=tier)
+        with self._lock:
+            old = self._prerendered
+            self._prerendered = (key, future, time.monotonic())
+        if old is not None:
+            old[1].cancel()  # superseded, no point rendering it if it hasn't started
+
+    def request(self, downscale=True, superlowres=False, settle=True, tier=None):
+        """ Return a Future for a screenshot, reusing the prerendered one
+            if it's recent and the right kind. Set settle to False if you
+            already know the screen isn't changing, to skip waiting for it """
+        with self._lock:
+            prerendered, self._prerendered = self._prerendered, None
+        future = None
+        if prerendered is not None:
+            key, future, started = prerendered
+            if (key != (downscale, superlowres, tier) or
+                    time.monotonic() - started > PRERENDER_MAX_AGE):
+                future.cancel()
+                future = None
+        if future is None:
+            future = self._executor.submit(take_screenshot, downscale,
+                                           superlowres, settle=settle, tier=tier)
+        return future
+
+    def refine(self, fingerprint, tier):
+        """ Return a Future for the frame with this fingerprint, encoded
+            with a different tier (see reencode_screenshot()) """
+        return self._executor.submit(reencode_screenshot, fingerprint, tier)
+
+    def then(self, future, function, *args):
+        """ Return a Future for function(future's result, *args), run on
+            the pool once future is done """
+        return self._executor.submit(lambda: function(future.result(), *args))
+
+    def take(self, downscale=True, superlowres=False):
+        """ Like request(), but block until the screenshot is ready """
+        return self.request(downscale, superlowres).result()
+
+
+service = ScreenshotService()
+
+# How many screenshots a single client can ask for: SCREENSHOT_BURST at once,
+# refilled at SCREENSHOT_RATE per second. Clicking through a deck as fast as
+# anyone can stays well below this
+SCREENSHOT_RATE = 4
+SCREENSHOT_BURST = 4
+
+
+class TokenBucket(object):
+    """ A token bucket rate limiter. take() spends a token if there is one,
+        otherwise it says how long until there will be """
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate or SCREENSHOT_RATE
+        self.burst = burst or SCREENSHOT_BURST
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()  # wifi connections have their own threads
+
+    def take(self, cost=1):
+        """ Return 0 if cost tokens were taken, or how many seconds to wait
+            before trying again """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= cost:
+                self._tokens -= cost
+                return 0
+            return (cost - self._tokens) / self.rate
@@ -33,14 +33,15 @@ import hashlib
 import hmac
 import json
 import logging
-import os
 import secrets
 import socket
 import time
-from datetime import datetime
-from threading import Thread
-from .screenshot import take_screenshot
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+from . import metrics
+from .screenshot import service, feed, variant, take_screenshot, TokenBucket
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 gi.require_version('NM', '1.0')
 from gi.repository import NM
 
@@ -78,10 +79,11 @@ def get_wifi_info():
     return ret
 
 
-def upgrade_connection(fd, client_info):
-    """ if on the same wifi - start the server, and tell the client we're up """
+def upgrade_connection(send, client_info):
+    """ if on the same wifi - start the server, and tell the client we're up.
+
+    send is a function that sends a message to the client over bluetooth """
     found_connection = None
-    client_info = json.loads(client_info)
     if not client_info['wifi']:
         logger.warn("wifi functionality is enabled, but this computer is not connected to any (secure) wifi network")
         return  # Client is not connected to any wifi network
@@ -114,7 +116,7 @@ def upgrade_connection(fd, client_info):
     response = json.dumps({'key': key_b64, 'uri': uri}).encode()
     padded_len = str(len(response)).zfill(4).encode()
     # response format: 'wifi', 4 bytes of response length, response
-    os.write(fd, b'wifi' + padded_len + response)
+    send(b'wifi' + padded_len + response)
 
     return server
 
@@ -123,53 +125,153 @@ def upgrade_connection(fd, client_info):
 # asyncio server, and implementing a GLib based server would require a lot more
 # code and be generally ugly.
 # Performance doesn't matter much as long as we can send the picture in
-# a reasonable time without slowing pageup/pagedown handling too much
+# a reasonable time without slowing pageup/pagedown handling too much.
+# Every connection gets its own thread, so a second phone or a slow client
+# doesn't hold up everyone else, and connections are kept alive between
+# requests (HTTP/1.1) to save the connection setup on busy wifi.
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True  # don't wait for keep-alive connections on exit
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closing = Event()  # tells streams to end
 
 
 class ServerThread(Thread):
     def __init__(self, addr, key, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._daemonic = True
+        self.daemon = True
         self.key = key
-        self.server = HTTPServer(addr, request_handler_factory(key))
+        self.server = ThreadingHTTPServer(addr, request_handler_factory(key))
         self.addr = self.server.socket.getsockname()
 
     def run(self):
         self.server.serve_forever()
 
     def stop(self):
+        self.server.closing.set()
         self.server.shutdown()
-
-seen_nonces = set()
+        self.server.server_close()
+
+REPLAY_WINDOW = 5  # seconds, requests with timestamps further off than this are refused
+STREAM_POLL_INTERVAL = 2  # seconds without a new screenshot before a stream checks itself
+
+
+class NonceStore(object):
+    """ Remembers the nonces seen within the replay window, to refuse
+        replayed requests.
+
+        Requests are only accepted if their timestamp is within
+        REPLAY_WINDOW seconds of ours, so a nonce can be forgotten once
+        that's no longer true for any timestamp it could've come with.
+        Nonces are kept in insertion order, which is also the order they
+        expire in, so checking and expiring are O(1). If we somehow get
+        more than max_entries valid requests within the window, new ones are
+        refused rather than forgetting nonces that could still be replayed. """
+    def __init__(self, window=REPLAY_WINDOW, max_entries=10000):
+        self.window = window
+        self.max_entries = max_entries
+        self._nonces = OrderedDict()  # nonce -> time it can be forgotten
+        self._lock = Lock()  # every connection has its own thread
+        self.accepted = 0
+        self.rejected_stale = 0
+        self.rejected_replay = 0
+        self.rejected_full = 0
+
+    def check(self, timestamp, nonce, now=None):
+        """ Return True if a request with this timestamp and nonce is not a
+            replay, and remember the nonce """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if abs(now - timestamp) > self.window:
+                self.rejected_stale += 1
+                return False
+            self._expire(now)
+            if nonce in self._nonces:
+                self.rejected_replay += 1
+                return False
+            if len(self._nonces) >= self.max_entries:
+                self.rejected_full += 1
+                return False
+            # the timestamp can be up to one window in the future, and stays
+            # acceptable for one more window after that
+            self._nonces[nonce] = now + 2 * self.window
+            self.accepted += 1
+            return True
+
+    def _expire(self, now):
+        while self._nonces:
+            nonce, expires = next(iter(self._nonces.items()))
+            if expires > now:
+                break
+            del self._nonces[nonce]
+
+    def __len__(self):
+        return len(self._nonces)
 
 
 def request_handler_factory(hmac_key):
     """ A factory to create a RequestHandler that knows the hmac key """
+    nonces = NonceStore()  # nonces are only meaningful for one key
+    # one key is one client, all its connections share a rate limit
+    bucket = TokenBucket()
+
     class RequestHandler(BaseHTTPRequestHandler):
         """ A simple HTTP request handler that validates the HMAC signature """
+        protocol_version = "HTTP/1.1"  # for keep-alive
+        timeout = 30  # drop idle keep-alive connections after this many seconds
+
+        def setup(self):
+            super().setup()
+            self.connected_at = time.monotonic()
+            metrics.connections.inc("wifi")
+
+        def finish(self):
+            try:
+                super().finish()
+            finally:
+                metrics.connection_seconds.observe(
+                    time.monotonic() - self.connected_at, "wifi")
+                metrics.connections.dec("wifi")
+
+        def send_screenshot(self, f, header=b"", trailer=b""):
+            """ Write a screenshot (with whatever goes around it) and count it """
+            start = time.perf_counter()
+            self.wfile.write(header)
+            self.wfile.write(f[0])
+            self.wfile.write(trailer)
+            self.wfile.flush()
+            metrics.transfer_seconds.observe(time.perf_counter() - start, "wifi")
+            metrics.bytes_sent.inc("wifi", amount=len(header) + len(f[0]) + len(trailer))
+            metrics.screenshots.inc("wifi", "pic")
+
+        def log_message(self, format, *args):
+            # The default writes every request to stderr
+            logger.debug("%s - %s", self.address_string(), format % args)
 
         def do_HEAD(self):
             self.send_response(200)
+            self.send_header("Content-Length", 0)
             self.end_headers()
 
-        def do_GET(self):
+        def authenticate(self):
+            """ Check the HMAC signature. Sends an error and returns False
+                if it's not valid """
             if 'X-Hmac' not in self.headers or 'X-Timestamp-nonce' not in self.headers:
                 self.send_error(401, "Not Authorized", "Authentication failure")
-                return
+                return False
             signature = self.headers['X-Hmac'].strip()
             msg = self.headers['X-Timestamp-nonce'].strip()
 
-            timestamp, nonce = msg.split(',')
-            utcnow = datetime.utcnow().timestamp()
-            if utcnow - float(timestamp) > 5:
-                # protect against replay attacks - refuse stale requests
-                self.send_error(401, "Not Authorized", "Authentication failure")
-                return
-
-            if nonce in seen_nonces:
-                # protect against replay attacks - don't allow nonce reuse
+            try:
+                timestamp, nonce = msg.split(',')
+                timestamp = float(timestamp)
+            except ValueError:
                 self.send_error(401, "Not Authorized", "Authentication failure")
-                return
+                return False
 
             valid_signature = base64.b64encode(hmac.new(hmac_key,
                                                         msg.encode(),
@@ -178,22 +280,96 @@ def request_handler_factory(hmac_key):
 
             if not hmac.compare_digest(signature, valid_signature):
                 self.send_error(401, "Not Authorized", "Authentication failure")
-                return
+                return False
+
+            # protect against replay attacks - refuse stale requests, and
+            # don't allow nonce reuse. This is checked after the signature,
+            # so unsigned junk can't fill up the nonce store
+            if not nonces.check(timestamp, nonce):
+                logger.warning("refused a stale or replayed request "
+                               "(stale: %s, replayed: %s, store full: %s)" %
+                               (nonces.rejected_stale, nonces.rejected_replay,
+                                nonces.rejected_full))
+                self.send_error(401, "Not Authorized", "Authentication failure")
+                return False
+            return True
 
-            seen_nonces.add(nonce)
+        def do_GET(self):
+            if not self.authenticate():
+                return
 
             # if we got here, authenction succeeded - now we can
             # send the screenshot
-
-            # sleep because sometimes the client is too fast
-            # and asks for screenshots before slides had time to change
-            time.sleep(0.3)
-            f = take_screenshot()
+            if self.path == "/stream":
+                metrics.commands.inc("http stream")
+                self.stream()
+                return
+            metrics.commands.inc("http")
+
+            wait = bucket.take()
+            if wait > 0:
+                # Too many requests. Whatever screenshot was taken last is
+                # as good as it gets without capturing again
+                version, f = feed.latest(variant())
+                if f is None:
+                    self.send_response(429)
+                    self.send_header("Retry-After", max(1, round(wait)))
+                    self.send_header("Content-Length", 0)
+                    self.end_headers()
+                    return
+                logger.debug("rate limited, sending the latest screenshot")
+            else:
+                # Usually this is the prerendered screenshot, or an already
+                # encoded one from the cache. Concurrent requests share one
+                # capture (see screenshot.FrameBroker)
+                f = service.take()
             self.send_response(200)
             self.send_header("Content-Type", f[1])
             self.send_header("Content-Length", len(f[0]))
             self.end_headers()
-            self.wfile.write(f[0])
+            self.send_screenshot(f)
+
+        def stream(self):
+            """ Push a new screenshot whenever the slide changes, as
+                multipart/x-mixed-replace, until the client goes away.
+
+                Screenshots are taken anyway after every keypress, and pushed
+                from there. The slide can also change without one (a video,
+                an animation, someone using the laptop), so when nothing new
+                came for STREAM_POLL_INTERVAL seconds, we take a screenshot
+                ourselves. It's only published if the fingerprint changed """
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            key = variant()
+            version, f = feed.latest(key)
+            if f is None:
+                f = service.take()
+                version, _ = feed.latest(key)
+            checked_at = time.monotonic()
+            try:
+                while not self.server.closing.is_set():
+                    if f is not None:
+                        header = (b"--frame\r\nContent-Type: %s\r\n"
+                                  b"Content-Length: %d\r\n\r\n" %
+                                  (f[1].encode(), len(f[0])))
+                        self.send_screenshot(f, header, b"\r\n")
+                        checked_at = time.monotonic()
+                    elif time.monotonic() - checked_at >= STREAM_POLL_INTERVAL:
+                        # publishes it (and wakes us up) if it's different,
+                        # other streams polling now share the capture
+                        try:
+                            take_screenshot(tier=key)
+                        except Exception:
+                            logger.exception("Checking the stream for changes failed")
+                        checked_at = time.monotonic()
+                    # wake up every now and then to check if we're shutting down
+                    version, f = feed.wait(key, version, timeout=1)
+            except OSError:  # broken pipe, connection reset, or a timeout
+                logger.info("screenshot stream closed by the client")
 
     return RequestHandler
 